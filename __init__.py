@@ -3,4 +3,7 @@
 import service
 import serialize
 import proxy
-import packet
\ No newline at end of file
+import packet
+import cache
+import loop
+import metrics
\ No newline at end of file
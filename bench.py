@@ -0,0 +1,920 @@
+'''
+nom -- Network Object Mirroring
+bench -- Benchmarks
+
+Loopback benchmarks for NOM. Each benchmark starts its own pair of Services
+on 127.0.0.1 (ephemeral ports), so this can be run from a checkout without
+any setup:
+
+	python bench.py [name ...]
+
+With no arguments, every benchmark is run. With --json PATH first, the
+measurements that benchmarks Record (all of suite's, for one) are also
+written to PATH, to compare between versions:
+
+	python bench.py --json before.json suite
+'''
+
+import os
+import sys
+import time
+import array
+import itertools
+import collections
+import signal
+import threading
+import Queue
+import json
+import multiprocessing
+
+import service
+import serialize
+import packet
+import cache
+import loop
+import metrics
+
+BENCHMARKS=[] #(name, function) in definition order
+CHILDREN=[] #pids of forked servers
+RESULTS=collections.OrderedDict() #benchmark -> {measure: stats}, for --json
+BLOB=os.urandom(1<<23) #Incompressible bytes for Target.Blob
+
+def Benchmark(func):
+	BENCHMARKS.append((func.__name__, func))
+	return func
+
+class Gate(object):
+	#Exported object whose Hold() parks a pull on the server until Open().
+	def __init__(self):
+		self.event=threading.Event()
+	def Hold(self):
+		self.event.wait()
+	def Open(self):
+		self.event.set()
+
+class Target(object):
+	def __init__(self):
+		self.value=1
+		for i in xrange(50):
+			setattr(self, 'field%d'%(i,), i)
+	def Echo(self, x):
+		return x
+	def Delay(self, x):
+		#Stands in for a slow link or slow remote work.
+		time.sleep(0.002)
+		return x
+	def Blob(self, size):
+		return BLOB[:size]
+	def Back(self, func, x):
+		#Calls back to the caller, from the worker running this pull.
+		return func(x)
+
+class Row(object):
+	#A small record, with FIELDS.
+	FIELDS=['f%d'%(i,) for i in xrange(10)]
+	def __init__(self):
+		for i, field in enumerate(self.FIELDS):
+			setattr(self, field, i)
+
+class ValueRow(Row):
+	pass
+serialize.ValueType(ValueRow)
+
+class Rows(object):
+	#Exported object whose methods return a Row, a ValueRow, and the same
+	#row as a namedtuple.
+	Tuple=collections.namedtuple('Tuple', Row.FIELDS)
+	def Ref(self):
+		return Row()
+	def Value(self):
+		return ValueRow()
+	def Named(self):
+		return self.Tuple(*range(len(Row.FIELDS)))
+
+class Items(object):
+	#A collection served by reference (a list itself would be copied).
+	def __init__(self, items):
+		self.items=items
+	def __getitem__(self, index):
+		return self.items[index]
+	def __len__(self):
+		return len(self.items)
+	def __iter__(self):
+		return iter(self.items)
+
+class Report(object):
+	#Exported object whose Rows(n) returns a listing like those a real
+	#service sends back: repetitive, and so compressible.
+	def Rows(self, n):
+		return [{'id': i, 'name': 'item%d'%(i,), 'owner': 'admin', 'state': 'ready', 'size': i*512} for i in xrange(n)]
+	def Text(self, n):
+		return '\n'.join('%6d  item%-6d admin  ready  %10d'%(i, i, i*512) for i in xrange(n))
+
+class MeteredSocket(object):
+	#Counts the bytes sent through a Service's socket.
+	def __init__(self, sock):
+		self.sock=sock
+		self.sent=0
+	def sendto(self, data, addr):
+		self.sent+=len(data)
+		return self.sock.sendto(data, addr)
+	def Sent(self):
+		return self.sent
+	def __getattr__(self, attr):
+		return getattr(self.sock, attr)
+
+class DelayedSocket(object):
+	#Holds each datagram sent through a Service's socket for delay seconds
+	#before sending it, as a long link would.
+	def __init__(self, sock, delay):
+		self.sock=sock
+		self.delay=delay
+		self.queue=Queue.Queue()
+		sender=threading.Thread(target=self.Send)
+		sender.daemon=True
+		sender.start()
+	def sendto(self, data, addr):
+		self.queue.put((time.time()+self.delay, data, addr))
+		return len(data)
+	def Send(self):
+		while True:
+			when, data, addr=self.queue.get()
+			time.sleep(max(0.0, when-time.time()))
+			self.sock.sendto(data, addr)
+	def __getattr__(self, attr):
+		return getattr(self.sock, attr)
+
+class Link(object):
+	#Exported object to chain calls on: each Next() is another Link.
+	def __init__(self, depth=0):
+		self.depth=depth
+	def Next(self):
+		return Link(self.depth+1)
+
+class Counter(object):
+	#Counts calls, so that a call run twice shows.
+	def __init__(self):
+		self.count=0
+	def Tick(self):
+		self.count+=1
+		return self.count
+
+def Pair(setup, transport=None, **kwargs):
+	#Serves the objects that setup(srv) registers from a forked child, and
+	#returns (client Service, Client) connected to it through transport. The
+	#ends run in separate processes so they don't contend for one GIL.
+	rd, wr=os.pipe()
+	pid=os.fork()
+	if pid==0:
+		os.close(rd)
+		srv=service.Service(('127.0.0.1', 0), **kwargs)
+		setup(srv)
+		srv.start()
+		os.write(wr, '%d\n'%(srv.addr[1],))
+		srv.join()
+		os._exit(0)
+	os.close(wr)
+	port=int(os.fdopen(rd).readline())
+	CHILDREN.append(pid)
+	cli=service.Service(('127.0.0.1', 0), **kwargs)
+	cli.start()
+	return cli, cli.Connect(('127.0.0.1', port), transport)
+
+def Reap():
+	while CHILDREN:
+		pid=CHILDREN.pop()
+		os.kill(pid, signal.SIGTERM)
+		os.waitpid(pid, 0)
+
+def Timed(func, count):
+	start=time.time()
+	for i in xrange(count):
+		func()
+	return (time.time()-start)/count
+
+def Latencies(func, count):
+	#The seconds each of count calls to func took, sorted.
+	times=[]
+	for i in xrange(count):
+		start=time.time()
+		func()
+		times.append(time.time()-start)
+	times.sort()
+	return times
+
+def Stats(times, secs=None):
+	#Throughput and percentiles of sorted per-op times. secs is how long the
+	#ops took in all, if they overlapped (as several clients' do).
+	n=len(times)
+	def Percentile(p):
+		return times[min(n-1, int(p*n))]*1e6
+	return collections.OrderedDict([
+		('ops', n),
+		('ops_per_sec', n/(secs or sum(times))),
+		('p50_usec', Percentile(0.5)),
+		('p99_usec', Percentile(0.99)),
+		('p999_usec', Percentile(0.999)),
+	])
+
+def RecordHeader():
+	print '%-20s %8s %12s %10s %10s %10s'%('', 'ops', 'ops/sec', 'p50 usec', 'p99 usec', 'p999 usec')
+
+def Record(bench, name, stats):
+	#Prints a row of stats (see Stats), and keeps it for --json.
+	RESULTS.setdefault(bench, collections.OrderedDict())[name]=stats
+	print '%-20s %8d %12.0f %10.1f %10.1f %10.1f'%((name,)+tuple(stats.values()))
+
+@Benchmark
+def inflight(count=500, levels=(0, 10, 50, 100, 200, 400)):
+	#Latency of one GetAttr while N other calls are parked in flight. With
+	#per-transaction dispatch this should stay flat as N grows.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+		srv.Register(Gate, 'Gate')
+	cli, conn=Pair(setup, workers=max(levels)+1) #A worker for every parked call
+	rt=conn.Resolve('Target')
+	mkgate=conn.Resolve('Gate')
+	print '%-10s %12s'%('in-flight', 'usec/GetAttr')
+	for level in levels:
+		gate=mkgate()
+		hold=gate.Hold
+		threads=[threading.Thread(target=lambda: hold()) for i in xrange(level)]
+		for th in threads:
+			th.daemon=True
+			th.start()
+		while len(cli.outstanding)<level:
+			time.sleep(0.01)
+		lat=Timed(lambda: rt.value, count)
+		print '%-10d %12.1f'%(level, lat*1e6)
+		gate.Open()
+		for th in threads:
+			th.join(1.0) #Replies dropped in the burst are resent, after a timeout
+
+@Benchmark
+def pipeline(count=1000, windows=(1, 8, 32, 128)):
+	#Call throughput one round trip at a time, and with calls kept in flight
+	#through Gather. On loopback, Echo is CPU-bound at both ends; Delay adds
+	#2ms of latency to every call, which is where pipelining pays.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	print '%-12s %12s %12s'%('window', 'Echo/sec', 'Delay/sec')
+	for window in (None,)+windows:
+		rates=[]
+		for meth in (target.Echo, target.Delay):
+			n=(count if meth is target.Echo else count/10)
+			start=time.time()
+			if window is None:
+				for i in xrange(n):
+					meth(i)
+			else:
+				service.Gather([cli.Call(conn, meth._obj.oid, i) for i in xrange(n)], window)
+			rates.append(n/(time.time()-start))
+		print '%-12s %12.0f %12.0f'%(window or 'blocking', rates[0], rates[1])
+
+@Benchmark
+def batch(count=50, rounds=20):
+	#Reading 50 attributes of one object, one round trip each versus one
+	#BATCH packet.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	names=['field%d'%(i,) for i in xrange(count)]
+	def Single():
+		return [getattr(target, name) for name in names]
+	def Batched():
+		with conn.Batch() as b:
+			bt=b.Bind(target)
+			results=[getattr(bt, name) for name in names]
+		return [res.Result() for res in results]
+	assert Single()==Batched()
+	single=Timed(Single, rounds)
+	batched=Timed(Batched, rounds)
+	print '%-10s %12s'%('', 'msec/%d reads'%(count,))
+	print '%-10s %12.2f'%('single', single*1e3)
+	print '%-10s %12.2f'%('batched', batched*1e3)
+
+@Benchmark
+def cached(count=2000):
+	#Repeated reads of one attribute under each cache policy.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	print '%-12s %12s'%('policy', 'usec/read')
+	for name, policy in (('none', None), ('Timed(1)', cache.Timed(1.0)), ('ReadOnce', cache.ReadOnce()), ('Subscribed', cache.Subscribed())):
+		service.Cache(target, policy)
+		target.value
+		print '%-12s %12.1f'%(name, Timed(lambda: target.value, count)*1e6)
+
+@Benchmark
+def soak(count=5000, every=1000):
+	#Server-side tracked objects while a client makes many calls that each
+	#return a fresh object and drops it. With distributed collection this
+	#should level off instead of growing with the number of calls.
+	def setup(srv):
+		srv.Register(Target, 'Target')
+		srv.Register(lambda: len(srv.omap), 'Tracked')
+	cli, conn=Pair(setup)
+	mktarget=conn.Resolve('Target')
+	tracked=conn.Resolve('Tracked')
+	print '%-10s %12s'%('calls', 'tracked')
+	for i in xrange(1, count+1):
+		mktarget().value
+		if i%every==0:
+			print '%-10d %12d'%(i, tracked())
+	time.sleep(cli.RELEASE_INTERVAL*2)
+	print '%-10s %12d'%('idle', tracked())
+
+@Benchmark
+def lossy(count=500, rates=(0.0, 0.01, 0.05, 0.2)):
+	#Calls to a non-idempotent method when each end drops a fraction of the
+	#datagrams it sends and duplicates 5% of the rest. Every call must run
+	#exactly once.
+	print '%-8s %12s %12s %10s'%('loss', 'calls/sec', 'msec worst', 'ran')
+	for rate in rates:
+		def setup(srv):
+			srv.sock=service.LossySocket(srv.sock, rate, 0.05)
+			srv.Register(Counter(), 'Counter')
+		cli, conn=Pair(setup)
+		cli.sock=service.LossySocket(cli.sock, rate, 0.05)
+		counter=conn.Resolve('Counter')
+		worst=0.0
+		start=time.time()
+		for i in xrange(count):
+			t=time.time()
+			counter.Tick()
+			worst=max(worst, time.time()-t)
+		elapsed=time.time()-start
+		print '%-8s %12.0f %12.1f %10d'%('%g%%'%(rate*100,), count/elapsed, worst*1e3, counter.count)
+		Reap()
+
+@Benchmark
+def chains(depths=(1, 2, 4, 8), count=20, delay=0.01):
+	#A chain of depth calls, each on the result of the last, then a read of
+	#the end's depth, over a link with delay seconds of latency each way:
+	#waiting for each result, and pipelined.
+	def setup(srv):
+		srv.Register(Link(), 'Link')
+	cli, conn=Pair(setup)
+	cli.sock=DelayedSocket(cli.sock, delay)
+	link=conn.Resolve('Link')
+	def Blocking(depth):
+		end=link
+		for i in xrange(depth):
+			end=end.Next()
+		assert end.depth==depth
+	def Pipelined(depth):
+		end=service.Pipelined(link)
+		for i in xrange(depth):
+			end=end.Next()
+		assert service.Await(end.depth)==depth
+	print '%-8s %14s %14s'%('depth', 'msec blocking', 'msec pipelined')
+	for depth in depths:
+		print '%-8d %14.1f %14.1f'%(depth, Timed(lambda: Blocking(depth), count)*1e3, Timed(lambda: Pipelined(depth), count)*1e3)
+	Reap()
+
+@Benchmark
+def methods(count=2000):
+	#Method calls as GetAttr then Call on the bound method, and as one
+	#CallMethod (once Resolve has listed the methods); and how many
+	#references the server sent for them, each one an object it tracks
+	#until the client releases it.
+	def setup(srv):
+		sent=[0]
+		track=srv.Track
+		def Track(obj):
+			sent[0]+=1
+			return track(obj)
+		srv.Track=Track
+		srv.Register(Target(), 'Target')
+		srv.Register(lambda: sent[0], 'Sent')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	sent=conn.Resolve('Sent')
+	listed=target._obj.methods
+	print '%-12s %12s %12s'%('', 'usec/call', 'refs sent')
+	for name, methods in (('GetAttr+Call', None), ('CallMethod', listed)):
+		target._obj.methods=methods
+		before=sent()
+		lat=Timed(lambda: target.Echo(1), count)
+		print '%-12s %12.1f %12d'%(name, lat*1e6, sent()-before)
+	Reap()
+
+@Benchmark
+def bulk(sizes=(1<<10, 1<<16, 1<<20, 1<<22, 1<<23), total=1<<25):
+	#Throughput of Call results too big for one datagram, which go out as
+	#paced fragments; and the same on a link that drops 1% of datagrams.
+	print '%-10s %12s %12s'%('bytes', 'MB/sec', 'MB/sec lossy')
+	for size in sizes:
+		rates=[]
+		for rate in (0.0, 0.01):
+			def setup(srv):
+				srv.sock=service.LossySocket(srv.sock, rate)
+				srv.Register(Target(), 'Target')
+			cli, conn=Pair(setup)
+			blob=conn.Resolve('Target').Blob
+			n=max(2, total/size)
+			assert len(blob(size))==size
+			rates.append(size/Timed(lambda: blob(size), n)/1e6)
+			Reap()
+		print '%-10d %12.1f %12.1f'%(size, rates[0], rates[1])
+
+@Benchmark
+def transport(count=2000, window=32, size=1<<22, total=1<<25):
+	#The same work over UDP and TCP: one call at a time, calls pipelined
+	#through Gather, and 4 MiB results.
+	print '%-6s %12s %12s %12s'%('', 'usec/call', 'calls/sec', 'MB/sec')
+	for name, tp in (('udp', service.DatagramTransport), ('tcp', service.StreamTransport)):
+		def setup(srv):
+			srv.Register(Target(), 'Target')
+		cli, conn=Pair(setup, tp, tcp=True)
+		target=conn.Resolve('Target')
+		echo, blob=target.Echo, target.Blob
+		latency=Timed(lambda: echo(1), count)
+		start=time.time()
+		service.Gather([cli.Call(conn, echo._obj.oid, i) for i in xrange(count)], window)
+		rate=count/(time.time()-start)
+		bulk=size/Timed(lambda: blob(size), total/size)
+		print '%-6s %12.1f %12.0f %12.1f'%(name, latency*1e6, rate, bulk/1e6)
+		Reap()
+
+@Benchmark
+def coroutines(counts=(100, 1000, 10000)):
+	#Tasks on one loop thread, each making one call through an AsyncProxy,
+	#all started at once, so that every call is in flight together.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	cli, conn=Pair(setup, depth=max(counts))
+	target=loop.AsyncProxy(conn.Resolve('Target'))
+	disp=loop.Dispatcher()
+	def Work(i):
+		x=yield target.Echo(i)
+		raise loop.Return(x)
+	print '%-10s %12s %12s'%('tasks', 'calls/sec', 'in flight')
+	for count in counts:
+		peak=[0]
+		def Sample():
+			peak[0]=max(peak[0], len(cli.outstanding))
+			if not done.Done():
+				threading.Timer(0.01, Sample).start()
+		start=time.time()
+		done=loop.All([loop.Task(disp, Work(i)) for i in xrange(count)])
+		Sample()
+		assert disp.Until(done).Result()==range(count)
+		print '%-10d %12.0f %12d'%(count, count/(time.time()-start), peak[0])
+
+@Benchmark
+def compression(count=100, thresholds=(None, 16384, 4096, 1024, 256), link=1e7):
+	#Calls whose results are listings of several sizes, with replies of
+	#threshold bytes or more compressed (the last also with a preset
+	#dictionary). Reports the time per call over loopback (mostly CPU), the
+	#bytes the reply took, and what a call would take on a link of link bits
+	#per second.
+	shapes=[('Rows', 10), ('Rows', 100), ('Rows', 1000), ('Text', 100), ('Text', 1000)]
+	zdict=serialize.Serialize(Report().Rows(10))
+	runs=[(threshold, '') for threshold in thresholds]+[(thresholds[-1], zdict)]
+	print '%-10s %-10s %-5s %12s %12s %14s'%('result', 'threshold', 'zdict', 'usec/call', 'bytes/reply', 'msec on link')
+	for threshold, dictionary in runs:
+		service.Service.ZDICT=dictionary
+		def setup(srv):
+			srv.sock=MeteredSocket(srv.sock)
+			srv.Register(srv.sock, 'Meter')
+			srv.Register(Report(), 'Report')
+		cli, conn=Pair(setup, compress=threshold)
+		meter=conn.Resolve('Meter')
+		report=conn.Resolve('Report')
+		for name, n in shapes:
+			func=getattr(report, name)
+			func(n)
+			before=meter.Sent()
+			secs=Timed(lambda: func(n), count)
+			size=(meter.Sent()-before)/count
+			print '%-10s %-10s %-5s %12.1f %12d %14.2f'%('%s(%d)'%(name, n), threshold, bool(dictionary), secs*1e6, size, (secs+size*8/link)*1e3)
+		Reap()
+	service.Service.ZDICT=''
+
+@Benchmark
+def values(count=500):
+	#Fetching a 10-field record and reading every field, when the record
+	#comes back as a reference (a pull per field), and copied whole.
+	def setup(srv):
+		srv.Register(Rows(), 'Rows')
+	cli, conn=Pair(setup)
+	rows=conn.Resolve('Rows')
+	print '%-8s %12s'%('record', 'usec/read')
+	for name in ('Ref', 'Value', 'Named'):
+		func=getattr(rows, name)
+		def Read():
+			row=func()
+			return [getattr(row, field) for field in Row.FIELDS]
+		assert Read()==range(len(Row.FIELDS))
+		print '%-8s %12.1f'%(name, Timed(Read, count)*1e6)
+	Reap()
+
+@Benchmark
+def iteration(size=1000000, indexed=2000):
+	#Walking a remote list of size items, and a remote generator of as many,
+	#with Iter's chunks; and the first indexed items of the list by index,
+	#a pull each, as iterating did before.
+	def setup(srv):
+		srv.Register(Items(range(size)), 'Items')
+		srv.Register(lambda n: (i for i in xrange(n)), 'Count')
+	cli, conn=Pair(setup)
+	items=conn.Resolve('Items')
+	count=conn.Resolve('Count')
+	ref=items._obj
+	print '%-10s %10s %12s %10s'%('how', 'items', 'items/sec', 'chunks')
+	def Indexed():
+		for i in xrange(indexed):
+			ref.GetItem(i)
+	secs=Timed(Indexed, 1)
+	print '%-10s %10d %12.0f %10d'%('GetItem', indexed, indexed/secs, indexed)
+	nexts=[]
+	def Next(*args):
+		nexts.append(args)
+		return service.Service.Next(cli, *args)
+	cli.Next=Next
+	for name, make in (('list', lambda: items), ('generator', lambda: count(size))):
+		del nexts[:]
+		start=time.time()
+		n=0
+		for item in make():
+			n+=1
+		secs=time.time()-start
+		chunks=1+len(nexts) #The first comes with the iterator
+		assert n==size
+		print '%-10s %10d %12.0f %10d'%(name, n, n/secs, chunks)
+	Reap()
+
+@Benchmark
+def xids(threads=32, count=20000, calls=200):
+	#Stress: xids taken by many threads at once, across the wrap, must be
+	#unique and skip those still outstanding; then calls (and calls back
+	#from the peer's workers) from many threads must each get their own
+	#reply.
+	srv=service.Service(('127.0.0.1', 0))
+	srv.xids=itertools.count(srv.XID_MASK-threads*count//2)
+	held=range(10)
+	for xid in held:
+		srv.outstanding[xid]=None
+	taken=[[] for i in xrange(threads)]
+	def Take(xids):
+		for i in xrange(count):
+			xids.append(srv.NewXID())
+	workers=[threading.Thread(target=Take, args=(xids,)) for xids in taken]
+	start=time.time()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	secs=time.time()-start
+	every=[xid for xids in taken for xid in xids]
+	assert len(set(every))==len(every), 'xid handed out twice'
+	assert not set(held)&set(every), 'outstanding xid handed out'
+	print '%-10s %10d %12.0f'%('NewXID', len(every), len(every)/secs)
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	wrong=[]
+	def Call(n):
+		for i in xrange(calls):
+			x=(n, i)
+			if target.Echo(x)!=x or target.Back(lambda y: y, x)!=x:
+				wrong.append(x)
+	workers=[threading.Thread(target=Call, args=(n,)) for n in xrange(threads)]
+	start=time.time()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	secs=time.time()-start
+	assert not wrong, '%d replies to the wrong call'%(len(wrong),)
+	print '%-10s %10d %12.0f'%('calls', threads*calls*2, threads*calls*2/secs)
+	Reap()
+
+@Benchmark
+def shards(processes=(1, 2, 4), clients=8, seconds=2.0):
+	#Echo calls per second from clients forked clients, each with its own
+	#Service (and so its own port, which the kernel hashes to a shard),
+	#against service.Serve with each number of processes. Scaling needs as
+	#many cores as shards, plus some for the clients.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+	print '%-10s %10s %12s'%('processes', 'calls', 'calls/sec')
+	for count in processes:
+		addr, pids=service.Serve(('127.0.0.1', 0), setup, count)
+		CHILDREN.extend(pids)
+		time.sleep(0.2) #Let the shards start listening
+		pipes=[]
+		for i in xrange(clients):
+			rd, wr=os.pipe()
+			pid=os.fork()
+			if pid==0:
+				os.close(rd)
+				cli=service.Service(('127.0.0.1', 0))
+				cli.start()
+				target=cli.Connect(addr).Resolve('Target')
+				n=0
+				end=time.time()+seconds
+				while time.time()<end:
+					target.Echo(n)
+					n+=1
+				os.write(wr, '%d\n'%(n,))
+				os._exit(0)
+			os.close(wr)
+			pipes.append((pid, rd))
+		calls=0
+		for pid, rd in pipes:
+			calls+=int(os.fdopen(rd).readline())
+			os.waitpid(pid, 0)
+		print '%-10d %10d %12.0f'%(count, calls, calls/seconds)
+		Reap()
+
+def ScanSerializer(obj):
+	#GetIdealSerializer as it was before the type cache, for comparison.
+	curser=None
+	curmrolen=0
+	for tp, ser in serialize.SERIALIZERS.iteritems():
+		if isinstance(obj, tp):
+			if len(tp.mro())>curmrolen:
+				curser=ser
+				curmrolen=len(tp.mro())
+	return curser
+
+PAYLOADS={
+	'pull': {'op': 'GetAttr', 'oid': 140234567890123L, 'attr': 'value', 'xid': 1234},
+	'call': {'op': 'Call', 'oid': 140234567890123L, 'xid': 1234, 'args': (1, 2.5, 'three', u'four', True, None), 'kwargs': {'five': 5}},
+	'ints': range(1000),
+	'strs': ['attribute%d'%(i,) for i in xrange(1000)],
+	'nested': [{'id': i, 'name': 'item%d'%(i,), 'tags': ('a', 'b'), 'score': i*0.5} for i in xrange(100)],
+}
+
+@Benchmark
+def encode(count=2000):
+	#serialize.Serialize throughput with and without the type cache.
+	print '%-8s %12s %12s %8s'%('payload', 'usec/scan', 'usec/cached', 'speedup')
+	cached=serialize.GetIdealSerializer
+	for name in sorted(PAYLOADS):
+		obj=PAYLOADS[name]
+		n=max(1, count*10/len(serialize.Serialize(obj)))
+		try:
+			serialize.GetIdealSerializer=ScanSerializer
+			scan=Timed(lambda: serialize.Serialize(obj), n)
+		finally:
+			serialize.GetIdealSerializer=cached
+		fast=Timed(lambda: serialize.Serialize(obj), n)
+		print '%-8s %12.1f %12.1f %7.2fx'%(name, scan*1e6, fast*1e6, scan/fast)
+
+def Corpus(srv, cli):
+	#(name, Packet) pairs typical of an interactive session, requests and
+	#replies alike.
+	CMD=service.CMD
+	target=Target()
+	oid=long(srv.Track(target)) #As RemoteReference holds it
+	return [
+		('SYNC', packet.Packet(CMD.SYNC, xid=0, format=serialize.FORMAT.LATEST)),
+		('SYNC reply', packet.Packet(CMD.SYNC, xid=0, result=True, format=serialize.FORMAT.LATEST)),
+		('LIST reply', packet.Packet(CMD.LIST, xid=1, result=['Target', 'Config', 'Log'])),
+		('RESOLVE', packet.Packet(CMD.RESOLVE, xid=2, name='Target')),
+		('RESOLVE reply', packet.Packet(CMD.RESOLVE, xid=2, name='Target', result=target)),
+		('GetAttr', packet.Packet(CMD.PULL, xid=3, op='GetAttr', oid=oid, attr='value')),
+		('GetAttr reply int', packet.Packet(CMD.PULL, xid=3, op='GetAttr', oid=oid, attr='value', result=42)),
+		('GetAttr reply ref', packet.Packet(CMD.PULL, xid=4, op='GetAttr', oid=oid, attr='Echo', result=target.Echo)),
+		('SetAttr float', packet.Packet(CMD.PULL, xid=5, op='SetAttr', oid=oid, attr='value', val=0.5)),
+		('SetAttr reply', packet.Packet(CMD.PULL, xid=5, op='SetAttr', oid=oid, attr='value', val=0.5, result=None)),
+		('Call', packet.Packet(CMD.PULL, xid=6, op='Call', oid=oid, args=(7, 'name', True), kwargs={'timeout': 30})),
+		('Call reply str', packet.Packet(CMD.PULL, xid=6, op='Call', oid=oid, args=(7, 'name', True), kwargs={'timeout': 30}, result='done')),
+		('Len reply', packet.Packet(CMD.PULL, xid=7, op='Len', oid=oid, result=1000)),
+		('GetItem slice', packet.Packet(CMD.PULL, xid=8, op='GetItem', oid=oid, item=slice(10, 20, 1))),
+		('GetItem reply list', packet.Packet(CMD.PULL, xid=8, op='GetItem', oid=oid, item=slice(10, 20, 1), result=range(10, 20))),
+		('Call reply bools', packet.Packet(CMD.PULL, xid=9, op='Call', oid=oid, args=(), kwargs={}, result=[True, False]*8)),
+		('Error reply', packet.Packet(CMD.PULL, xid=10, op='GetAttr', oid=oid, attr='missing', error=AttributeError('missing'))),
+	]
+
+@Benchmark
+def wiresize():
+	#Bytes on the wire for each packet of the corpus, in every format; and
+	#in the latest once the strs in it are interned with the peer.
+	srv=service.Service(('127.0.0.1', 0))
+	cli=srv.GetClient(('127.0.0.1', 1))
+	formats=range(serialize.FORMAT.LATEST+1)
+	print '%-20s'%('packet',)+''.join('%10s'%('fmt %d'%(fmt,),) for fmt in formats)+'%10s'%('interned',)
+	totals=[0]*(len(formats)+1)
+	for name, pkt in Corpus(srv, cli):
+		cli.strings.known.clear()
+		sizes=[len(pkt.ToStr(fmt, cli)) for fmt in formats]
+		defined=[]
+		pkt.ToStr(serialize.FORMAT.LATEST, cli, defined)
+		cli.strings.Confirm(defined) #As if the peer answered
+		sizes.append(len(pkt.ToStr(serialize.FORMAT.LATEST, cli, [])))
+		totals=[t+sz for t, sz in zip(totals, sizes)]
+		print '%-20s'%(name,)+''.join('%10d'%(sz,) for sz in sizes)
+	print '%-20s'%('total',)+''.join('%10d'%(t,) for t in totals)
+	print '%-20s'%('vs. fmt 0',)+''.join('%9.0f%%'%(100.0*t/totals[0],) for t in totals)
+
+@Benchmark
+def codec(count=2000):
+	#Packet.ToStr and FromStr over the corpus, in every format; decoding from
+	#a str, and in place from a receive buffer, as DatagramTransport does.
+	srv=service.Service(('127.0.0.1', 0))
+	cli=srv.GetClient(('127.0.0.1', 1))
+	corpus=[pkt for name, pkt in Corpus(srv, cli)]
+	print '%-8s %12s %12s %12s'%('format', 'usec/encode', 'usec/decode', 'in place')
+	for fmt in xrange(serialize.FORMAT.LATEST+1):
+		datas=[pkt.ToStr(fmt, cli) for pkt in corpus]
+		bufs=[buffer(bytearray(data)) for data in datas]
+		enc=Timed(lambda: [pkt.ToStr(fmt, cli) for pkt in corpus], count)
+		dec=Timed(lambda: [packet.Packet.FromStr(data, cli) for data in datas], count)
+		inplace=Timed(lambda: [packet.Packet.FromStr(buf, cli) for buf in bufs], count)
+		n=len(corpus)
+		print '%-8d %12.2f %12.2f %12.2f'%(fmt, enc/n*1e6, dec/n*1e6, inplace/n*1e6)
+
+@Benchmark
+def arrays(size=100000, count=10):
+	#Serialize and Deserialize of big numeric sequences, item by item (as
+	#FORMAT.COMPACT sends them) and packed.
+	vectors=[
+		('floats', [i*0.5 for i in xrange(size)]),
+		('ints', range(size)),
+		('array d', array.array('d', xrange(size))),
+	]
+	print '%-8s %-8s %12s %12s %12s'%('', 'format', 'msec/encode', 'msec/decode', 'bytes')
+	for name, obj in vectors:
+		for fmt in (serialize.FORMAT.COMPACT, serialize.FORMAT.ARRAYS):
+			def Encode():
+				fout=serialize.Writer(fmt)
+				serialize.Serialize(obj, fout)
+				return fout.getvalue()
+			data=Encode()
+			enc=Timed(Encode, count)
+			dec=Timed(lambda: serialize.Deserialize(serialize.Reader(data, fmt)), count)
+			print '%-8s %-8d %12.2f %12.2f %12d'%(name, fmt, enc*1e3, dec*1e3, len(data))
+
+@Benchmark
+def instrumented(count=5000):
+	#Call latency with neither end measuring itself, and with both; then
+	#where the server's pulls spent their time, as metrics.Metrics saw it.
+	def Measure(srv, on):
+		srv.metrics=None
+		if on:
+			srv.metrics=metrics.Metrics()
+			srv.metrics.Attach(srv)
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+		srv.Register(lambda on: Measure(srv, on), 'Measure')
+		srv.Register(lambda: srv.metrics.Snapshot(), 'Snapshot')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	measure=conn.Resolve('Measure')
+	RecordHeader()
+	for on in (False, True):
+		measure(on)
+		Measure(cli, on)
+		for name, func in (('Call', lambda: target.Echo(1)), ('Delay', lambda: target.Delay(1))):
+			Record('instrumented', '%s %s'%(name, ('measured' if on else 'plain')), Stats(Latencies(func, count if name=='Call' else count/10)))
+	snap=conn.Resolve('Snapshot')()
+	print
+	print '%-20s %8s %10s %10s'%('server pulls', 'count', 'p50 usec', 'p99 usec')
+	for name, hist in sorted(snap['targets'].items(), key=lambda item: -item[1]['total_sec']):
+		print '%-20s %8d %10.1f %10.1f'%(name, hist['count'], hist['p50_usec'], hist['p99_usec'])
+	Reap()
+
+@Benchmark
+def fanout(subscribers=(10, 50, 200), count=100, size=1024):
+	#Getting an event of size bytes to every subscriber, each a Service in
+	#one forked child: as a Call to each, kept in flight together, against
+	#Topic.Publish with acks (each encoded once, and answered once per
+	#subscriber) and without (timed as sent; then how many arrived).
+	payload=os.urandom(size)
+	pub=service.Service(('127.0.0.1', 0))
+	pub.start()
+	topic=pub.Topic('bench')
+	RecordHeader()
+	for n in subscribers:
+		rd, wr=os.pipe()
+		pid=os.fork()
+		if pid==0:
+			os.close(rd)
+			heard=itertools.count()
+			srvs=[]
+			for i in xrange(n):
+				srv=service.Service(('127.0.0.1', 0))
+				srv.Register(Target(), 'Target')
+				srv.Register(lambda: heard.next(), 'Heard') #Counts itself, too
+				srv.start()
+				srv.Connect(pub.addr).Subscribe('bench', lambda event: heard.next())
+				srvs.append(srv)
+			os.write(wr, ' '.join(str(srv.addr[1]) for srv in srvs)+'\n')
+			srvs[0].join()
+			os._exit(0)
+		os.close(wr)
+		ports=[int(port) for port in os.fdopen(rd).readline().split()]
+		CHILDREN.append(pid)
+		conns=[pub.Connect(('127.0.0.1', port)) for port in ports]
+		oids=[conn.Resolve('Target')._obj.oid for conn in conns]
+		heard=conns[0].Resolve('Heard')
+		def Calls():
+			service.Gather([pub.CallMethod(conn, oid, 'Echo', payload) for conn, oid in zip(conns, oids)], n)
+		Record('fanout', '%d Call'%(n,), Stats(Latencies(Calls, count)))
+		missing=[0]
+		def Acked():
+			missing[0]+=len(topic.Publish(payload, acks=True).Wait(5.0))
+		Record('fanout', '%d Publish acks'%(n,), Stats(Latencies(Acked, count)))
+		before=heard()
+		Record('fanout', '%d Publish'%(n,), Stats(Latencies(lambda: topic.Publish(payload), count)))
+		time.sleep(1.0)
+		print '%-20s %8d of %d delivered, %d acks missing'%('', heard()-before-1, n*count, missing[0])
+		Reap()
+		for conn in conns:
+			pub.Desync(conn)
+
+@Benchmark
+def suite(count=5000, clients=(1, 4, 16), payload=1<<20):
+	#Throughput and latency percentiles of the common operations, one at a
+	#time: GetAttr, a method Call, GetItem with a slice, a Call that calls
+	#back into the client, and a payload-byte result; then Calls from several
+	#client processes at once; then Serialize and Deserialize alone.
+	def setup(srv):
+		srv.Register(Target(), 'Target')
+		srv.Register(Items(range(1000)), 'Items')
+	cli, conn=Pair(setup)
+	target=conn.Resolve('Target')
+	items=conn.Resolve('Items')
+	back=lambda x: x
+	RecordHeader()
+	for name, func, n in (
+		('GetAttr', lambda: target.value, count),
+		('Call', lambda: target.Echo(1), count),
+		('GetItem slice', lambda: items[10:20], count),
+		('Callback', lambda: target.Back(back, 1), count),
+		('Blob %dKiB'%(payload>>10,), lambda: target.Blob(payload), max(10, count/100)),
+	):
+		Record('suite', name, Stats(Latencies(func, n)))
+	for n in clients:
+		#Each client connects, then waits for the rest, so that their calls
+		#overlap; its times come back through a pipe.
+		start=time.time()+0.5+0.05*n
+		pipes=[]
+		for i in xrange(n):
+			rd, wr=os.pipe()
+			pid=os.fork()
+			if pid==0:
+				os.close(rd)
+				srv=service.Service(('127.0.0.1', 0))
+				srv.start()
+				echo=srv.Connect(conn.addr).Resolve('Target').Echo
+				time.sleep(max(0.0, start-time.time()))
+				began=time.time()
+				times=Latencies(lambda: echo(1), max(100, count/n))
+				os.write(wr, json.dumps([began, time.time(), times]))
+				os._exit(0)
+			os.close(wr)
+			pipes.append((pid, rd))
+		runs=[]
+		for pid, rd in pipes:
+			runs.append(json.loads(os.fdopen(rd).read()))
+			os.waitpid(pid, 0)
+		secs=max(end for began, end, times in runs)-min(began for began, end, times in runs)
+		Record('suite', 'Call x%d clients'%(n,), Stats(sorted(t for began, end, times in runs for t in times), secs))
+	Reap()
+	fmt=serialize.FORMAT.LATEST
+	for name in sorted(PAYLOADS):
+		obj=PAYLOADS[name]
+		def Encode():
+			fout=serialize.Writer(fmt)
+			serialize.Serialize(obj, fout)
+			return fout.getvalue()
+		data=Encode()
+		n=max(1000, count*20/len(data))
+		Record('suite', 'Serialize %s'%(name,), Stats(Latencies(Encode, n)))
+		Record('suite', 'Deserialize %s'%(name,), Stats(Latencies(lambda: serialize.Deserialize(serialize.Reader(data, fmt)), n)))
+
+def main(args):
+	path=None
+	if args[:1]==['--json']:
+		path, args=args[1], args[2:]
+	names=args or [name for name, func in BENCHMARKS]
+	funcs=dict(BENCHMARKS)
+	try:
+		for name in names:
+			print '==', name
+			funcs[name]()
+	finally:
+		Reap()
+	if path is not None:
+		with open(path, 'w') as f:
+			json.dump(collections.OrderedDict([
+				('time', time.time()),
+				('python', sys.version.split()[0]),
+				('platform', sys.platform),
+				('cpus', multiprocessing.cpu_count()),
+				('format', serialize.FORMAT.LATEST),
+				('results', RESULTS),
+			]), f, indent=1)
+
+if __name__=='__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,87 @@
+'''
+nom -- Network Object Mirroring
+cache -- Remote attribute caching
+
+A RemoteReference may keep the results of GetAttr and Len in a Cache, so
+repeated reads of values that rarely change don't each cost a round trip.
+What counts as fresh is decided by a policy:
+-Timed(ttl): entries are good for ttl seconds.
+-ReadOnce(): entries are good forever (methods, constants, ...).
+-Subscribed(): entries are good until the owning Service says otherwise; it
+ pushes new values or invalidations whenever the object's attributes or items
+ are changed through NOM. Changes made any other way (by the owner's local
+ code, or by a method called remotely) are NOT seen, so only use this for
+ objects that are mutated through their attributes.
+All policies bound the number of entries, evicting the least recently used.
+'''
+
+import time
+import threading
+import collections
+
+class Policy(object):
+	SUBSCRIBE=False #True if the owning Service must push changes
+	def __init__(self, size=256):
+		self.size=size
+	def Fresh(self, stamp, now):
+		raise NotImplementedError(type(self).__name__+' does not define freshness.')
+
+class Timed(Policy):
+	def __init__(self, ttl, size=256):
+		Policy.__init__(self, size)
+		self.ttl=ttl
+	def Fresh(self, stamp, now):
+		return now-stamp<self.ttl
+
+class ReadOnce(Policy):
+	def Fresh(self, stamp, now):
+		return True
+
+class Subscribed(Policy):
+	SUBSCRIBE=True
+	def Fresh(self, stamp, now):
+		return True
+
+#Keys for the things a RemoteReference caches.
+def AttrKey(attr):
+	return ('attr', attr)
+LEN_KEY=('len',)
+
+class Cache(object):
+	def __init__(self, policy):
+		self.policy=policy
+		self.entries=collections.OrderedDict() #key -> (value, stamp)
+		self.lock=threading.Lock()
+		self.generation=0 #Bumped by every invalidation
+	def Get(self, key):
+		#Returns (True, value) on a fresh hit, otherwise (False, None).
+		with self.lock:
+			try:
+				value, stamp=self.entries.pop(key)
+			except KeyError:
+				return (False, None)
+			if not self.policy.Fresh(stamp, time.time()):
+				return (False, None)
+			self.entries[key]=(value, stamp) #Now the most recently used
+			return (True, value)
+	def Generation(self):
+		return self.generation
+	def Put(self, key, value, generation=None):
+		#A value fetched before an invalidation may already be stale; pass
+		#the Generation() from before the fetch to have it dropped.
+		with self.lock:
+			if generation is not None and generation!=self.generation:
+				return
+			self.entries.pop(key, None)
+			self.entries[key]=(value, time.time())
+			while len(self.entries)>self.policy.size:
+				self.entries.popitem(False)
+	def Invalidate(self, key=None):
+		with self.lock:
+			self.generation+=1
+			if key is None:
+				self.entries.clear()
+			else:
+				self.entries.pop(key, None)
+	def __len__(self):
+		return len(self.entries)
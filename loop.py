@@ -0,0 +1,267 @@
+'''
+nom -- Network Object Mirroring
+loop -- Event loop integration
+
+A proxy waits for every reply, and a Service runs pulls on worker threads;
+neither suits a program built around an event loop. This module lets such a
+program use NOM from the loop's thread without blocking it:
+-A Dispatcher runs jobs on the loop's thread. Any thread may Submit() one;
+ the loop watches the Dispatcher's fileno() and calls Run() when it's
+ readable (or calls Until() to run jobs itself).
+-AsyncProxy(prx) is a proxy whose operations return futures at once. Calling
+ a method of one sends the call as soon as the method arrives, so
+ prx.Method(x) is a single future.
+-A Task runs a generator as a coroutine on a Dispatcher. Yielding a future (or
+ a list of them) suspends it until the result is in, which is sent back in,
+ or raised there if it's an error. Raise Return(value) to finish with a value;
+ a Task is itself a future of it:
+	def Work(obj):
+		name=yield obj.name
+		size=yield obj.Size(name)
+		raise loop.Return(size)
+	task=loop.Task(disp, Work(loop.AsyncProxy(obj)))
+-A Service hands its pulls to a Dispatcher put in place of its worker pool:
+	srv.pool=disp
+ The objects it serves are then only touched on the loop's thread, so they
+ needn't be thread-safe; but they mustn't wait on a remote peer, or the loop
+ stalls, and every peer waiting on it with it.
+None of this changes the protocol, so these peers talk to any other.
+'''
+
+import os
+import fcntl
+import select
+import threading
+import traceback
+import collections
+
+import proxy
+import service
+
+class Dispatcher(object):
+	def __init__(self):
+		self.jobs=collections.deque() #(func, args)
+		self.lock=threading.Lock()
+		self.signalled=False #True if the pipe holds a wakeup not yet read
+		self.rd, self.wr=os.pipe()
+		for fd in (self.rd, self.wr):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL)|os.O_NONBLOCK)
+	def fileno(self):
+		return self.rd
+	def Submit(self, func, args=(), lane=None):
+		#As WorkerPool.Submit. Jobs run one at a time in the order given, so
+		#every lane is kept in order anyway.
+		self.jobs.append((func, args))
+		self.Wake()
+		return True
+	def Wake(self):
+		with self.lock:
+			if self.signalled:
+				return
+			self.signalled=True
+		os.write(self.wr, 'x')
+	def Run(self):
+		#Runs the jobs submitted so far; jobs they submit wait for the next Run.
+		with self.lock:
+			self.signalled=False
+			try:
+				os.read(self.rd, 4096)
+			except OSError:
+				pass
+		for i in xrange(len(self.jobs)):
+			func, args=self.jobs.popleft()
+			try:
+				func(*args)
+			except Exception:
+				print 'Exception encountered in dispatched job:'
+				traceback.print_exc()
+		if self.jobs:
+			self.Wake()
+	def Until(self, fut=None):
+		#Runs jobs as they come until fut is done, or forever if it's None.
+		while fut is None or not fut.Done():
+			select.select([self.rd], [], [], 1.0)
+			self.Run()
+		return fut
+
+def Outcome(fut):
+	#(True, result) or (False, error) of a finished future.
+	try:
+		return (True, fut.Result())
+	except Exception, e:
+		return (False, e)
+
+class Future(object):
+	#A result that's set once, by whatever produces it, with the interface of
+	#a DeferredResult.
+	def __init__(self):
+		self.ready=False
+		self.ok=False
+		self.value=None
+		self.event=threading.Event()
+		self.lock=threading.Lock()
+		self.callbacks=[]
+	def Set(self, ok, value):
+		with self.lock:
+			self.ok=ok
+			self.value=value
+			self.ready=True
+			callbacks, self.callbacks=self.callbacks, []
+		self.event.set()
+		for func in callbacks:
+			self.Fire(func)
+	def Done(self):
+		return self.ready
+	def Result(self, timeout=None):
+		#Blocks until the result is in; on the loop's thread, yield instead.
+		if not self.event.wait(timeout):
+			raise service.Timeout('No result in %r seconds'%(timeout,))
+		if not self.ok:
+			raise self.value
+		return self.value
+	def Error(self, timeout=None):
+		try:
+			self.Result(timeout)
+		except service.Timeout:
+			raise
+		except Exception, e:
+			return e
+		return None
+	def AddCallback(self, func):
+		#func(self) is called by whatever thread sets the result, or right
+		#away, if it's set already.
+		with self.lock:
+			if not self.ready:
+				self.callbacks.append(func)
+				return
+		self.Fire(func)
+	def Fire(self, func):
+		try:
+			func(self)
+		except Exception:
+			print 'Exception encountered in future callback:'
+			traceback.print_exc()
+	#The concurrent.futures spellings, for code written against those.
+	result=Result
+	done=Done
+	exception=Error
+	add_done_callback=AddCallback
+
+def All(futs):
+	#A future of the results of every future in futs, in order. The first
+	#error is raised once all have finished.
+	futs=list(futs)
+	fut=Future()
+	results=[None]*len(futs)
+	errors=[]
+	left=[len(futs)]
+	lock=threading.Lock()
+	def Finish(i, done):
+		ok, value=Outcome(done)
+		with lock:
+			if ok:
+				results[i]=value
+			elif not errors:
+				errors.append(value)
+			left[0]-=1
+			if left[0]:
+				return
+		if errors:
+			fut.Set(False, errors[0])
+		else:
+			fut.Set(True, results)
+	if not futs:
+		fut.Set(True, results)
+	for i, each in enumerate(futs):
+		each.AddCallback(lambda done, i=i: Finish(i, done))
+	return fut
+
+class Return(Exception):
+	#Raised by a Task's generator to finish with value.
+	def __init__(self, value=None):
+		Exception.__init__(self, value)
+		self.value=value
+
+class Task(Future):
+	def __init__(self, disp, gen):
+		Future.__init__(self)
+		self.disp=disp
+		self.gen=gen
+		disp.Submit(self.Step, (True, None))
+	def Step(self, ok, value):
+		try:
+			if ok:
+				fut=self.gen.send(value)
+			else:
+				fut=self.gen.throw(value)
+		except StopIteration:
+			self.Set(True, None)
+			return
+		except Return, r:
+			self.Set(True, r.value)
+			return
+		except Exception, e:
+			self.Set(False, e)
+			return
+		if isinstance(fut, (list, tuple)):
+			fut=All(fut)
+		if not hasattr(fut, 'AddCallback'):
+			self.disp.Submit(self.Step, (False, TypeError('Tasks can only yield futures, not %r'%(fut,))))
+			return
+		fut.AddCallback(lambda fut: self.disp.Submit(self.Step, Outcome(fut)))
+
+class Attribute(object):
+	#The future value of a remote attribute. It may be called, as a method
+	#usually is, without waiting for it; the call goes out when it arrives.
+	def __init__(self, act):
+		self.act=act
+	def Done(self):
+		return self.act.Done()
+	def Result(self, timeout=None):
+		return self.act.Result(timeout)
+	def Error(self, timeout=None):
+		return self.act.Error(timeout)
+	def AddCallback(self, func):
+		self.act.AddCallback(lambda act: func(self))
+	result=Result
+	done=Done
+	exception=Error
+	add_done_callback=AddCallback
+	def __call__(self, *args, **kwargs):
+		fut=Future()
+		def Arrived(act):
+			ok, value=Outcome(act)
+			if not ok:
+				fut.Set(False, value)
+			elif isinstance(value, proxy.Proxy) and isinstance(value._obj, service.RemoteReference):
+				ref=value._obj
+				call=ref.srv.Call(ref.cli, ref.oid, *args, **kwargs).Go()
+				#value is kept until the call is answered, so the method stays held.
+				call.AddCallback(lambda call, value=value: fut.Set(*Outcome(call)))
+			else:
+				try:
+					fut.Set(True, value(*args, **kwargs))
+				except Exception, e:
+					fut.Set(False, e)
+		self.act.AddCallback(Arrived)
+		return fut
+
+class AsyncReference(service.RemoteReference):
+	#A RemoteReference whose operations all return futures.
+	def __init__(self, ref):
+		service.RemoteReference.__init__(self, ref.srv, ref.cli, ref.oid)
+		self.blocking=False
+		self.methods=ref.methods
+		self.shared=ref #The object stays held as long as this is around
+	def GetAttr(self, attr):
+		if self.methods is not None and attr in self.methods:
+			return self.Method(attr) #Calls return futures
+		return Attribute(self.srv.GetAttr(self.cli, self.oid, attr).Go())
+
+def AsyncProxy(prx):
+	#A proxy for the same remote object as prx whose operations return
+	#futures, to be yielded from a Task.
+	ref=prx._obj
+	if isinstance(ref, service.MethodReference):
+		return proxy.Proxy(service.MethodReference(AsyncReference(ref.ref), ref.name))
+	return proxy.Proxy(AsyncReference(ref))
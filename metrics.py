@@ -0,0 +1,177 @@
+'''
+nom -- Network Object Mirroring
+metrics -- Instrumentation
+
+A Service with a Metrics object in its .metrics attribute (or given one as
+its metrics argument) reports what it does to it, as it does it: bytes in
+and out of each peer, the requests it handles, how long each pull ran (by
+op, and by the type and attribute it acted on, which is how slow remote
+objects show up), how long its own requests took to be answered, and how
+long packets took to encode and decode. With no Metrics (the default), the
+Service only ever checks for one.
+
+Snapshot() returns all of it as plain dicts, lists and numbers (ready for
+json.dumps), along with gauges read from the Service at that moment. Times
+go into Histograms, which keep counts in buckets a power of two wide, so
+recording is cheap and percentiles are approximate (to within a factor of
+two, from above).
+
+To trace instead, or to feed another system, subclass Metrics and override
+the hooks (Received, Sent, Handled, Pulled, Answered, Encoded, Decoded);
+they're called from the Service's threads, and must not block.
+'''
+
+import math
+import time
+import threading
+import collections
+
+class Histogram(object):
+	#Counts of durations, in buckets of microseconds 2**(n-1) to 2**n.
+	BUCKETS=40
+	def __init__(self):
+		self.count=0
+		self.total=0.0
+		self.max=0.0
+		self.buckets=[0]*self.BUCKETS
+	def Add(self, secs):
+		self.count+=1
+		self.total+=secs
+		if secs>self.max:
+			self.max=secs
+		self.buckets[min(max(math.frexp(secs*1e6)[1], 0), self.BUCKETS-1)]+=1
+	def Percentile(self, p):
+		#The upper bound, in seconds, of the bucket the p'th quantile is in.
+		rank=p*self.count
+		seen=0
+		for n, count in enumerate(self.buckets):
+			seen+=count
+			if seen>=rank and count:
+				return min(2.0**n/1e6, self.max)
+		return self.max
+	def Snapshot(self):
+		if not self.count:
+			return {'count': 0}
+		return collections.OrderedDict([
+			('count', self.count),
+			('total_sec', self.total),
+			('mean_usec', self.total/self.count*1e6),
+			('p50_usec', self.Percentile(0.5)*1e6),
+			('p99_usec', self.Percentile(0.99)*1e6),
+			('p999_usec', self.Percentile(0.999)*1e6),
+			('max_usec', self.max*1e6),
+		])
+
+class Peer(object):
+	#What passed between the Service and one peer.
+	def __init__(self):
+		self.packets_in=0
+		self.bytes_in=0
+		self.packets_out=0
+		self.bytes_out=0
+		self.requests=0 #Requests the peer made
+		self.answered=0 #Requests made of the peer, and answered
+		self.errors=0 #...with an error
+	def Snapshot(self):
+		return dict(vars(self))
+
+class Metrics(object):
+	def __init__(self):
+		self.lock=threading.Lock()
+		self.srv=None
+		self.Reset()
+	def Attach(self, srv):
+		#Called by the Service this is given to, for its gauges.
+		self.srv=srv
+	def Reset(self):
+		with self.lock:
+			self.since=time.time()
+			self.peers=collections.defaultdict(Peer) #addr -> Peer
+			self.handled=collections.defaultdict(int) #op or command -> count
+			self.pulls=collections.defaultdict(Histogram) #op -> run time
+			self.targets=collections.defaultdict(Histogram) #'Type.attr' -> run time
+			self.errors=collections.defaultdict(int) #op -> pulls that raised
+			self.rtt=collections.defaultdict(Histogram) #op or command -> time to answer
+			self.encode=Histogram()
+			self.decode=Histogram()
+			self.encoded=0 #Bytes
+			self.decoded=0
+	#The hooks; see the module documentation.
+	def Received(self, addr, nbytes):
+		with self.lock:
+			peer=self.peers[addr]
+			peer.packets_in+=1
+			peer.bytes_in+=nbytes
+	def Sent(self, addr, nbytes, npackets):
+		with self.lock:
+			peer=self.peers[addr]
+			peer.packets_out+=npackets
+			peer.bytes_out+=nbytes
+	def Handled(self, addr, name):
+		#A fresh request from addr: a pull's op, or else the command's name.
+		with self.lock:
+			self.peers[addr].requests+=1
+			self.handled[name]+=1
+	def Pulled(self, addr, op, target, secs, ok):
+		#A pull from addr ran for secs. target names what it acted on.
+		with self.lock:
+			self.pulls[op].Add(secs)
+			self.targets[target].Add(secs)
+			if not ok:
+				self.errors[op]+=1
+	def Answered(self, addr, name, secs, ok):
+		#A request made of addr was answered, secs after it was first sent.
+		with self.lock:
+			peer=self.peers[addr]
+			peer.answered+=1
+			if not ok:
+				peer.errors+=1
+			self.rtt[name].Add(secs)
+	def Encoded(self, secs, nbytes):
+		with self.lock:
+			self.encode.Add(secs)
+			self.encoded+=nbytes
+	def Decoded(self, secs, nbytes):
+		with self.lock:
+			self.decode.Add(secs)
+			self.decoded+=nbytes
+	def Gauges(self):
+		#Readings of the Service's state right now.
+		srv=self.srv
+		if srv is None:
+			return {}
+		return collections.OrderedDict([
+			('outstanding', len(srv.outstanding)), #Requests awaiting answers
+			('running', len(srv.running)), #Requests being handled
+			('queued', len(srv.pool.jobs)), #...of those, waiting for a worker
+			('objects', len(srv.omap)), #Objects tracked
+			('references', len(srv.refs)), #Remote objects referred to
+			('replies', len(srv.replies)), #Kept for resent requests...
+			('reply_bytes', srv.replybytes), #...and their size
+			('partial', len(srv.partial)), #Packets being reassembled
+			('kept', len(srv.kept)), #Results of pipelined pulls
+			('clients', len(srv.clients)),
+		])
+	def Snapshot(self):
+		def Each(hists):
+			return dict((key, hist.Snapshot()) for key, hist in hists.iteritems())
+		with self.lock:
+			snap=collections.OrderedDict([
+				('seconds', time.time()-self.since),
+				('peers', dict(('%s:%d'%addr[:2], peer.Snapshot()) for addr, peer in self.peers.iteritems())),
+				('handled', dict(self.handled)),
+				('pulls', Each(self.pulls)),
+				('pull_errors', dict(self.errors)),
+				('targets', Each(self.targets)),
+				('round_trips', Each(self.rtt)),
+				('encode', self.encode.Snapshot()),
+				('encoded_bytes', self.encoded),
+				('decode', self.decode.Snapshot()),
+				('decoded_bytes', self.decoded),
+			])
+		snap['gauges']=self.Gauges()
+		return snap
+	def Slowest(self, n=10):
+		#The n targets pulls spent the most time in, as (target, Histogram).
+		with self.lock:
+			return sorted(self.targets.items(), key=lambda item: -item[1].total)[:n]
@@ -5,18 +5,80 @@ Uses the general serializer interface to create network packets.
 These packets MUST be read on boundaries, and never across them;
 a transport like UDP, or TCP with length prefixes, should work
 for these purposes.
+
+The first byte of a packet is its header: the command in the low bits, and
+the serialize.FORMAT the rest was written in above them, so a packet can
+always be read without knowing what its sender negotiated. From
+FORMAT.INTERN, a byte follows with a bit for each of the HEADER attributes the
+packet has; they come next, by position, and the rest after them.
+
+From FORMAT.COMPRESSED, the top bit of the header may be set, in which case
+everything after the header is zlib-compressed, by the Codec both ends agreed
+on (see Codec).
 '''
 
+import zlib
+
 import serialize
 
+CMD_MASK=0x0f
+FORMAT_SHIFT=4
+FORMAT_MASK=0x70
+COMPRESSED=0x80
+HEADER=('xid', 'op', 'oid', 'attr') #Attributes of nearly every pull
+HEADER_BITS=[(1<<bit, attr) for bit, attr in enumerate(HEADER)]
+
+class Codec(object):
+	#Compresses packets of threshold bytes or more (never, if threshold is
+	#None) with zlib at level. A preset dictionary of strings likely to turn
+	#up in packets helps compress them; both ends must have the same one, so
+	#it is named by its id, which is 0 for none. This zlib can't be given one
+	#directly, so each stream starts from a copy of one that has already
+	#compressed the dictionary, and doesn't send that part.
+	LIMIT=1<<26 #Most bytes a compressed packet may expand to
+	def __init__(self, threshold=None, level=6, dictionary=''):
+		self.threshold=threshold
+		self.level=level
+		self.id=zlib.adler32(dictionary) if dictionary else 0
+		self.comp=self.decomp=None
+		if dictionary:
+			self.comp=zlib.compressobj(level)
+			prefix=self.comp.compress(dictionary)+self.comp.flush(zlib.Z_SYNC_FLUSH)
+			self.decomp=zlib.decompressobj()
+			self.decomp.decompress(prefix)
+	def Compress(self, data):
+		if self.comp is None:
+			return zlib.compress(data, self.level)
+		comp=self.comp.copy()
+		return comp.compress(data)+comp.flush()
+	def Decompress(self, data):
+		decomp=zlib.decompressobj() if self.decomp is None else self.decomp.copy()
+		data=decomp.decompress(data, self.LIMIT)
+		if decomp.unconsumed_tail:
+			raise ValueError('Compressed packet expands past %d bytes'%(self.LIMIT,))
+		return data
+PLAIN=Codec() #Decompresses packets from peers with no dictionary
+
 
 class Packet(object):
 	def __init__(self, cmd, **kwargs):
 		self.cmd=cmd
 		self.attrs=kwargs
 	@classmethod
-	def FromStr(cls, s):
-		return cls(ord(s[0]), **serialize.Deserialize(s[1:]))
+	def FromStr(cls, s, peer=None):
+		header=ord(s[0])
+		if header&COMPRESSED:
+			s=(getattr(peer, 'codec', None) or PLAIN).Decompress(buffer(s, 1))
+			fin=serialize.Reader(s, (header&FORMAT_MASK)>>FORMAT_SHIFT, peer)
+		else:
+			fin=serialize.Reader(s, (header&FORMAT_MASK)>>FORMAT_SHIFT, peer, offset=1)
+		if fin.format<serialize.FORMAT.INTERN:
+			return cls(header&CMD_MASK, **serialize.Deserialize(fin))
+		present=ord(fin.read(1))
+		head=[(attr, serialize.ReadObject(fin)) for bit, attr in HEADER_BITS if present&bit]
+		attrs=serialize.Deserialize(fin)
+		attrs.update(head)
+		return cls(header&CMD_MASK, **attrs)
 	@classmethod
 	def Make(cls, obj):
 		if isinstance(obj, cls):
@@ -39,8 +101,36 @@ class Packet(object):
 			self.attrs[attr]=val
 	def __delattr__(self, attr):
 		del self.attrs[attr]
+	def ToStr(self, format=serialize.FORMAT.BASE, peer=None, defined=None, codec=None):
+		#defined, if a list, lets strs be defined to peer (see
+		#serialize.StringTable); their indices are added to it. codec, if
+		#given, compresses the packet if it is long enough and that helps.
+		fout=serialize.Writer(format, peer)
+		fout.defined=defined
+		fout.write(chr(self.cmd|(format<<FORMAT_SHIFT)))
+		if format<serialize.FORMAT.INTERN:
+			serialize.Serialize(self.attrs, fout)
+			return fout.getvalue()
+		rest=dict(self.attrs)
+		present=0
+		head=[]
+		for bit, attr in HEADER_BITS:
+			if attr in rest:
+				present|=bit
+				head.append(rest.pop(attr))
+		fout.write(chr(present))
+		for value in head:
+			serialize.WriteObject(value, fout)
+		serialize.WriteObject(rest, fout)
+		data=fout.getvalue()
+		if codec is None or codec.threshold is None or len(data)<codec.threshold or format<serialize.FORMAT.COMPRESSED:
+			return data
+		packed=codec.Compress(buffer(data, 1))
+		if len(packed)+1>=len(data):
+			return data
+		return chr(ord(data[0])|COMPRESSED)+packed
 	def __str__(self):
-		return chr(self.cmd)+serialize.Serialize(self.attrs)
+		return self.ToStr()
 	def __repr__(self):
 		#return '<Packet cmd=%d %r>'%(self.cmd, self.attrs)
 		return '<Packet cmd=%d %r>'%(self.cmd, self.attrs.keys())
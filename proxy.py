@@ -11,6 +11,8 @@ of these calls between a proxy and reverse proxy, including the NOM-
 fundamental transformation of mapping these to object calls.
 '''
 
+import itertools
+
 class Proxy(object):
 	def __init__(self, obj):
 		self._obj=obj
@@ -35,6 +37,8 @@ class Proxy(object):
 		self._obj.DelItem(item)
 	def __len__(self):
 		return self._obj.Len()
+	def __iter__(self):
+		return self._obj.Iter()
 	def __repr__(self):
 		return self._obj.Repr()
 	def __str__(self):
@@ -59,9 +63,20 @@ class ReverseProxy(object):
 		del self._obj[item]
 	def Len(self):
 		return len(self._obj)
+	def Iter(self, count):
+		#Returns the first count items, and the iterator the rest come from
+		#(see Next), or None if there are no more.
+		it=iter(self._obj)
+		items=list(itertools.islice(it, count))
+		return items, (it if len(items)==count else None)
+	def Next(self, count):
+		#Returns up to count more items of an iterator; fewer once it ends.
+		return list(itertools.islice(iter(self._obj), count))
 	def Repr(self):
 		return repr(self._obj)
 	def Str(self):
 		return str(self._obj)
 	def Call(self, *args, **kwargs):
-		return self._obj(*args, **kwargs)
\ No newline at end of file
+		return self._obj(*args, **kwargs)
+	def CallMethod(self, attr, *args, **kwargs):
+		return getattr(self._obj, attr)(*args, **kwargs)
\ No newline at end of file
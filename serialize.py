@@ -26,14 +26,54 @@ In this case, the "ser" object will be called as above, but without the
 implicit "cls" parameter (as they are not necessarily classmethods). Users
 can use this to override arbitrary serializers, but this is generally never
 a good idea.
+
+Serializers read and write through a Reader or Writer, which wrap a stream
+and carry the wire FORMAT agreed with the peer (as .format) and the peer
+itself, if known (as .peer). Serializers that don't care about either may
+treat them as plain files. Formats only ever add encodings; Deserialize
+understands all of them, and Serialize writes whichever the stream asks for.
+
+A Writer appends to a bytearray, and a Reader reads its data (a str, or a
+buffer of a bytearray, such as a socket's recvfrom_into buffer) in place, so
+neither copies more than the values themselves. Fixed-size fields are packed
+with the precompiled structs below, not by format string.
+
+From FORMAT.ARRAYS, lists of PACK_MIN or more ints or floats (all of one
+type), array.arrays, and numpy arrays, if numpy is installed, are sent packed:
+their type, shape and raw bytes. ARRAY_DECODE chooses what they come back as.
+
+From FORMAT.INTERN, strs are interned. Those in STATIC_STRINGS are always sent
+as their index; a peer's StringTable (peer.strings) holds the rest, which
+requests define to the peer as they go, and send as an index once the peer
+has answered one of them.
+
+From FORMAT.VALUES, namedtuples, frozensets, classes declared with ValueType,
+and objects wrapped in ByValue are copied whole, as their state, rather than
+sent as references (or, for namedtuples, as plain tuples).
 '''
 
+import re
+import sys
+import array
+import collections
 import struct
+import types
+import operator
+import itertools
+import binascii
+import threading
 import cStringIO
 import exceptions
 
+try:
+	import numpy
+except ImportError:
+	numpy=None
+
 SERIALIZERS={} #type -> BaseSerializer derivative (a type)
 TAGS={} #tag (int) -> BaseSerializer derivative
+CACHE={} #type -> serializer chosen by GetIdealSerializer for its instances
+GENERATION=[0] #Bumped whenever CACHE is invalidated
 
 CURTAG=0 #BaseSerializer always gets this. Consider it invalid.
 
@@ -44,6 +84,11 @@ TEXT_ERROR_MODE='replace' #Silently drop errors with "unknown" characters.
 #likely come about during Deserialize calls, and wherever Deserialize is
 #implicitly done, such as packet parsing, etc.)
 
+ARRAY_DECODE=None #What packed sequences come back as: None for the type sent
+#(numpy arrays being array.arrays, or nested lists, where there's no numpy);
+#'list', 'array' (flattened), or 'numpy', for read-only numpy arrays over the
+#received bytes.
+
 #BaseSerializer's metaclass (SerializerMeta) automatically takes care of this
 #from the __types__ tuple provided in the class definition. However...if you
 #set that after-the-fact, you'll want to call either this function or the next
@@ -51,6 +96,7 @@ TEXT_ERROR_MODE='replace' #Silently drop errors with "unknown" characters.
 def SetSerializer(tp, ser):
 	SERIALIZERS[tp]=ser
 	TAGS[ser.__tag__]=ser
+	InvalidateCache()
 
 def UpdateSerializer(ser):
 	remove=[]
@@ -61,6 +107,228 @@ def UpdateSerializer(ser):
 		del SERIALIZERS[tp]
 	for tp in ser.__types__:
 		SERIALIZERS[tp]=ser
+	InvalidateCache()
+
+#Any change to SERIALIZERS can change the ideal serializer of any type, so
+#the whole cache goes. If you modify SERIALIZERS directly, call this.
+def InvalidateCache():
+	GENERATION[0]+=1
+	CACHE.clear()
+
+class FORMAT:
+	BASE=0 #Fixed 4-byte ints and lengths, decimal longs
+	COMPACT=1 #Varint ints, lengths and OIDs; one-byte bools; binary longs
+	ARRAYS=2 #Packed numeric sequences
+	INTERN=3 #Interned strs; positional packet header (see packet.HEADER)
+	COMPRESSED=4 #Packets may be compressed (see packet.Codec)
+	VALUES=5 #Value types (see ValueSerializer)
+	PROMISES=6 #Pulls on the results of earlier ones (see service.Promise)
+FORMAT.LATEST=FORMAT.PROMISES
+
+INT32=struct.Struct('!l')
+DOUBLE=struct.Struct('!d')
+
+class Writer(object):
+	def __init__(self, format=FORMAT.BASE, peer=None, stream=None):
+		self.format=format
+		self.peer=peer
+		self.strings=getattr(peer, 'strings', None)
+		self.defined=None #If a list, strs may be defined to the peer, their indices added here
+		self.stream=stream
+		if stream is None:
+			#bytearray.extend is a C call, like cStringIO's write, and half
+			#the cost.
+			self.buf=bytearray()
+			self.write=self.buf.extend
+		else:
+			self.write=stream.write
+	def getvalue(self):
+		if self.stream is None:
+			return str(self.buf)
+		return self.stream.getvalue()
+
+class Reader(object):
+	def __init__(self, data=None, format=FORMAT.BASE, peer=None, stream=None, offset=0):
+		self.format=format
+		self.peer=peer
+		self.strings=getattr(peer, 'strings', None)
+		self.used=getattr(peer, 'used', None) #If a list, gets (index, str) of each peer str read
+		if stream is None:
+			if isinstance(data, bytearray):
+				data=buffer(data)
+			stream=cStringIO.StringIO(data) #Reads data in place, without a copy
+			if offset:
+				stream.seek(offset)
+		self.stream=stream
+		self.read=self.stream.read
+
+#Unsigned LEB128; ZigZag maps signed integers onto it so that small
+#magnitudes of either sign stay short.
+def WriteVarint(n, fout):
+	if n<0x80:
+		fout.write(chr(n))
+		return
+	out=[]
+	while n>=0x80:
+		out.append(chr((n&0x7f)|0x80))
+		n>>=7
+	out.append(chr(n))
+	fout.write(''.join(out))
+
+def ReadVarint(fin):
+	n=0
+	shift=0
+	while True:
+		b=ord(fin.read(1))
+		n|=(b&0x7f)<<shift
+		if b<0x80:
+			return n
+		shift+=7
+
+def ZigZag(n):
+	return (n<<1) if n>=0 else ((-n)<<1)-1
+
+def UnZigZag(n):
+	return (n>>1) if not n&1 else -((n+1)>>1)
+
+#Lengths and counts of the containers below.
+def WriteLength(n, fout):
+	if fout.format>=FORMAT.COMPACT:
+		WriteVarint(n, fout)
+	else:
+		IntSerializer.Serialize(n, fout)
+
+def ReadLength(fin):
+	if fin.format>=FORMAT.COMPACT:
+		return ReadVarint(fin)
+	return IntSerializer.Deserialize(fin)
+
+#Bytes that aren't worth interning, as BytesSerializer writes them before
+#FORMAT.INTERN.
+def WriteBytes(data, fout):
+	WriteLength(len(data), fout)
+	fout.write(data)
+
+def ReadBytes(fin):
+	return fin.read(ReadLength(fin))
+
+#Interned strs. Their length is shifted up to make room for one of these:
+LITERAL=0 #Just the str
+INDEX=1 #The index of a str both ends have in place of the length, and no str
+DEFINE=2 #The index of the str, and then the str, which the reader keeps
+ECHO=3 #The index the reader defined a str as, and no str
+#These are every peer's, and can't change: the indices peers intern more of
+#their own as, in a StringTable (up to its LIMIT), start after them.
+STATIC_STRINGS=[
+	'xid', 'op', 'oid', 'attr', 'val', 'item', 'args', 'kwargs', 'result',
+	'error', 'name', 'format', 'pending', 'msg', 'index', 'count', 'data',
+	'reply', 'missing', 'ops', 'oids', 'len', 'GetAttr', 'SetAttr', 'DelAttr',
+	'GetItem', 'SetItem', 'DelItem', 'Len', 'Repr', 'Str', 'Call', 'Subscribe',
+	'Unsubscribe', 'UTF-8',
+]
+STATIC_INDEX=dict((string, index) for index, string in enumerate(STATIC_STRINGS))
+INTERN_MAX=64 #Longer strs aren't interned...
+INTERNABLE=re.compile(r'[A-Za-z_]\w*\Z') #...nor those that aren't names
+
+class StringTable(object):
+	#The strs interned with one peer: those defined to it, which it's known to
+	#have once it answers a request that defined them, and those it defined,
+	#which can be echoed back to it. Definitions that go astray are simply
+	#made again, and a peer only sends the index of a str it knows the reader
+	#has, so loss and reordering are harmless. Tables that share a peer (as
+	#the shards of a Service do) assign every stride'th index from offset, and
+	#may tell each other what they assign through onassign(index, str).
+	LIMIT=4096 #Most strs defined to the peer
+	RECEIVED=LIMIT*16 #Most the peer may define (16 shards' worth)
+	def __init__(self, stride=1, offset=0):
+		self.stride=stride
+		self.offset=offset
+		self.onassign=None
+		self.lock=threading.Lock()
+		self.assigned={} #str -> index, of those defined to the peer...
+		self.names={} #...and the reverse
+		self.known={} #str -> index, of those the peer has
+		self.received={} #index -> str, of those the peer defined...
+		self.echo={} #...and the reverse
+	def Assign(self, string):
+		#Returns the index to define string as, or None if the table is full.
+		with self.lock:
+			index=self.assigned.get(string)
+			if index is not None or len(self.assigned)>=self.LIMIT:
+				return index
+			index=self.assigned[string]=len(STATIC_STRINGS)+len(self.assigned)*self.stride+self.offset
+			self.names[index]=string
+		if self.onassign is not None:
+			self.onassign(index, string)
+		return index
+	def Confirm(self, indices):
+		#The peer answered a request that defined these.
+		for index in indices:
+			self.known[self.names[index]]=index
+	def Receive(self, index, string):
+		#The peer picks the indices and strs, so they're checked here like
+		#the rest of what it sends, and there are at most RECEIVED of them.
+		if index<len(STATIC_STRINGS) or len(string)>INTERN_MAX or not INTERNABLE.match(string):
+			raise ValueError('Bad interned str %d'%(index,))
+		old=self.received.get(index)
+		if old is None and len(self.received)>=self.RECEIVED:
+			raise ValueError('Too many interned strs')
+		if old!=string:
+			if old is not None:
+				self.echo.pop(old, None)
+			self.received[index]=string
+			self.echo[string]=index
+	def Forget(self):
+		#The peer may have started over, as it does at SYNC. Indices it
+		#defined before may still come, and still mean the same, but it might
+		#not know them any more.
+		self.known.clear()
+		self.echo.clear()
+
+def WriteString(string, fout):
+	index=STATIC_INDEX.get(string)
+	if index is None and fout.strings is not None:
+		index=fout.strings.known.get(string)
+		if index is None:
+			index=fout.strings.echo.get(string)
+			if index is not None:
+				WriteVarint((index<<2)|ECHO, fout)
+				return
+			if fout.defined is not None and len(string)<=INTERN_MAX and INTERNABLE.match(string):
+				index=fout.strings.Assign(string)
+				if index is not None:
+					WriteVarint((index<<2)|DEFINE, fout)
+					WriteBytes(string, fout)
+					fout.defined.append(index)
+					return
+	if index is not None:
+		WriteVarint((index<<2)|INDEX, fout)
+	else:
+		WriteVarint((len(string)<<2)|LITERAL, fout)
+		fout.write(string)
+
+def ReadString(fin):
+	n=ReadVarint(fin)
+	kind=n&3
+	n>>=2
+	if kind==LITERAL:
+		return fin.read(n)
+	if kind==DEFINE:
+		string=intern(ReadBytes(fin))
+		if fin.strings is not None:
+			fin.strings.Receive(n, string)
+		if fin.used is not None:
+			fin.used.append((n, string))
+		return string
+	if kind==INDEX and n<len(STATIC_STRINGS):
+		return STATIC_STRINGS[n]
+	try:
+		string=(fin.strings.received if kind==INDEX else fin.strings.names)[n]
+	except (AttributeError, KeyError):
+		raise ValueError('Unknown interned str %d'%(n,))
+	if kind==INDEX and fin.used is not None:
+		fin.used.append((n, string))
+	return string
 
 #This seems like it may be useful, but it's not particularly pragmatic
 #except for readability and (maybe) type monkey-patching.
@@ -81,6 +349,7 @@ class TAG:
 	ELLIPSIS=12
 	ERROR=13
 	USER=14
+	VALUE=254 #Out of the way of USER tags (the object serializer takes 255)
 
 def RegisterTag(name):
 	if not hasattr(TAG, name):
@@ -114,42 +383,57 @@ class IntSerializer(BaseSerializer):
 	__tag__=TAG.INT
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!l', obj))
+		if fout.format>=FORMAT.COMPACT:
+			WriteVarint(ZigZag(obj), fout)
+		else:
+			fout.write(INT32.pack(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!l', fin.read(struct.calcsize('!l')))[0]
+		if fin.format>=FORMAT.COMPACT:
+			return UnZigZag(ReadVarint(fin))
+		return INT32.unpack(fin.read(INT32.size))[0]
 	
 class LongSerializer(BaseSerializer):
 	__types__=(long,)
 	__tag__=TAG.LONG
 	@classmethod
 	def Serialize(cls, obj, fout):
-		BytesSerializer.Serialize(str(obj), fout)
+		if fout.format>=FORMAT.COMPACT:
+			#Big-endian bytes of the ZigZagged magnitude.
+			digits='%x'%(ZigZag(obj),)
+			WriteBytes(binascii.unhexlify('0'*(len(digits)&1)+digits), fout)
+		else:
+			WriteBytes(str(obj), fout)
 	@classmethod
 	def Deserialize(cls, fin):
-		return long(BytesSerializer.Deserialize(fin))
+		if fin.format>=FORMAT.COMPACT:
+			return long(UnZigZag(long(binascii.hexlify(ReadBytes(fin)), 16)))
+		return long(ReadBytes(fin))
 
 class FloatSerializer(BaseSerializer):
 	__types__=(float,)
 	__tag__=TAG.FLOAT
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!d', obj))
+		fout.write(DOUBLE.pack(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!d', fin.read(struct.calcsize('!d')))[0]
+		return DOUBLE.unpack(fin.read(DOUBLE.size))[0]
 
 class BytesSerializer(BaseSerializer):
 	__types__=(str,)
 	__tag__=TAG.BYTES
 	@classmethod
 	def Serialize(cls, obj, fout):
-		IntSerializer.Serialize(len(obj), fout)
-		fout.write(obj)
+		if fout.format>=FORMAT.INTERN:
+			WriteString(obj, fout)
+		else:
+			WriteBytes(obj, fout)
 	@classmethod
 	def Deserialize(cls, fin):
-		l=IntSerializer.Deserialize(fin)
-		return fin.read(l)
+		if fin.format>=FORMAT.INTERN:
+			return ReadString(fin)
+		return ReadBytes(fin)
 
 class TextSerializer(BaseSerializer):
 	__types__=(unicode,)
@@ -157,11 +441,11 @@ class TextSerializer(BaseSerializer):
 	@classmethod
 	def Serialize(cls, obj, fout):
 		BytesSerializer.Serialize(PREFERRED_ENCODING, fout)
-		BytesSerializer.Serialize(obj.encode(PREFERRED_ENCODING, TEXT_ERROR_MODE), fout)
+		WriteBytes(obj.encode(PREFERRED_ENCODING, TEXT_ERROR_MODE), fout)
 	@classmethod
 	def Deserialize(cls, fin):
 		codec=BytesSerializer.Deserialize(fin)
-		data=BytesSerializer.Deserialize(fin)
+		data=ReadBytes(fin)
 		try:
 			return data.decode(codec, TEXT_ERROR_MODE)
 		except LookupError:
@@ -175,16 +459,51 @@ class BoolSerializer(BaseSerializer):
 	__tag__=TAG.BOOL
 	@classmethod
 	def Serialize(cls, obj, fout):
-		IntSerializer.Serialize((1 if obj else 0), fout)
+		if fout.format>=FORMAT.COMPACT:
+			ByteSerializer.Serialize((1 if obj else 0), fout)
+		else:
+			IntSerializer.Serialize((1 if obj else 0), fout)
 	@classmethod
 	def Deserialize(cls, fin):
+		if fin.format>=FORMAT.COMPACT:
+			return bool(ByteSerializer.Deserialize(fin))
 		return bool(IntSerializer.Deserialize(fin))
 
+#Packed sequences carry a numpy-style dtype string: byte order, kind (i, u or
+#f) and item size. Of the array typecodes, these hold numbers ('c' and 'u'
+#hold characters).
+NUMERIC_CODES='bBhHiIlLfd'
+BYTEORDER=('<' if sys.byteorder=='little' else '>')
+
+def Kind(code):
+	return ('u' if code.isupper() else ('f' if code in 'fd' else 'i'))
+
+def ArrayDType(arr):
+	return ('|' if arr.itemsize==1 else BYTEORDER)+Kind(arr.typecode)+str(arr.itemsize)
+
+ARRAY_CODES=dict(((Kind(code), array.array(code).itemsize), code) for code in NUMERIC_CODES)
+INT_CODES=[(code, -1<<(8*array.array(code).itemsize-1)) for code in 'bhil'] #Narrowest first
+
+def Nest(items, shape):
+	#The flat items of an array of the given shape, as nested lists.
+	if not shape:
+		return items[0]
+	for k in xrange(len(shape)-1, 0, -1):
+		dim=shape[k]
+		items=[items[i*dim:(i+1)*dim] for i in xrange(reduce(operator.mul, shape[:k], 1))]
+	return items
+
 class SequenceSerializer(BaseSerializer):
-	__types__=(list, tuple, set)
+	__types__=(list, tuple, set, array.array)+((numpy.ndarray,) if numpy is not None else ())
 	__tag__=TAG.SEQ
 	SEQ_TYPE_MAP={0: list, 1: tuple, 2: set, 'next': 3}
 	SEQ_ID_MAP={list: 0, tuple: 1, set: 2}
+	#Ids of packed sequences, by what they were sent as; see Pack.
+	PACKED_LIST=253
+	PACKED_ARRAY=254
+	PACKED_NDARRAY=255
+	PACK_MIN=8 #Shorter lists aren't worth checking
+	EMPTY_ROWS=4096 #Most lists a packed sequence with no items may unpack into
 	@classmethod
 	def RegisterType(cls, seqtp):
 		cls.__types__+=(seqtp,)
@@ -195,17 +514,98 @@ class SequenceSerializer(BaseSerializer):
 		return cls.SEQ_TYPE_MAP['next']-1
 	@classmethod
 	def Serialize(cls, obj, fout):
-		IntSerializer.Serialize(len(obj), fout)
-		ByteSerializer.Serialize(cls.SEQ_ID_MAP[type(obj)], fout)
+		packed=(cls.Pack(obj) if fout.format>=FORMAT.ARRAYS else None)
+		if packed is not None:
+			seqid, dtype, shape, data=packed
+			WriteLength(reduce(operator.mul, shape, 1), fout)
+			ByteSerializer.Serialize(seqid, fout)
+			BytesSerializer.Serialize(dtype, fout)
+			WriteLength(len(shape), fout)
+			for dim in shape:
+				WriteLength(dim, fout)
+			WriteBytes(data, fout)
+			return
+		seqid=cls.SEQ_ID_MAP.get(type(obj))
+		if seqid is None:
+			#An array, to a peer that can't take it packed (or of things that
+			#don't pack), goes as a list.
+			seqid=0
+			obj=obj.tolist()
+			if not isinstance(obj, list): #A 0-dimensional numpy array
+				obj=[obj]
+		WriteLength(len(obj), fout)
+		ByteSerializer.Serialize(seqid, fout)
 		for item in obj:
-			Serialize(item, fout)
+			WriteObject(item, fout)
+	@classmethod
+	def Pack(cls, obj):
+		#Returns (id, dtype, shape, data) for obj as a packed sequence, or
+		#None if it's not numbers of one type.
+		tp=type(obj)
+		if tp is list:
+			if len(obj)<cls.PACK_MIN:
+				return None
+			tps=set(map(type, obj))
+			if tps==set([float]):
+				arr=array.array('d', obj)
+			elif tps==set([int]):
+				lo, hi=min(obj), max(obj)
+				for code, low in INT_CODES:
+					if low<=lo and hi<=~low:
+						break
+				arr=array.array(code, obj)
+			else:
+				return None
+			return (cls.PACKED_LIST, ArrayDType(arr), (len(arr),), arr.tostring())
+		if tp is array.array:
+			if obj.typecode not in NUMERIC_CODES:
+				return None
+			return (cls.PACKED_ARRAY, ArrayDType(obj), (len(obj),), obj.tostring())
+		if numpy is not None and isinstance(obj, numpy.ndarray):
+			if (obj.dtype.kind, obj.dtype.itemsize) not in ARRAY_CODES:
+				return None #So that a peer without numpy can read what is sent
+			return (cls.PACKED_NDARRAY, obj.dtype.str, obj.shape, numpy.ascontiguousarray(obj).tostring())
+		return None
+	@classmethod
+	def Unpack(cls, seqid, fin):
+		dtype=BytesSerializer.Deserialize(fin)
+		shape=tuple(ReadLength(fin) for i in xrange(ReadLength(fin)))
+		data=ReadBytes(fin)
+		#Both come from the peer; a shape with more items than data would
+		#have us build them all before finding out.
+		try:
+			code=ARRAY_CODES[dtype[1], int(dtype[2:])]
+		except (KeyError, ValueError, IndexError):
+			code=None
+		if code is None or dtype[0] not in '<>|':
+			raise ValueError('Bad packed sequence dtype %r'%(dtype,))
+		if min(shape or (0,))<0 or reduce(operator.mul, shape, 1)*array.array(code).itemsize!=len(data):
+			raise ValueError('Packed sequence of shape %r has %d bytes'%(shape, len(data)))
+		want=ARRAY_DECODE or {cls.PACKED_LIST: 'list', cls.PACKED_ARRAY: 'array', cls.PACKED_NDARRAY: 'numpy'}[seqid]
+		if want=='numpy' and numpy is not None:
+			return numpy.frombuffer(data, numpy.dtype(dtype)).reshape(shape)
+		arr=array.array(code)
+		arr.fromstring(data)
+		if dtype[0] not in ('|', BYTEORDER):
+			arr.byteswap()
+		if want=='array' or (want=='numpy' and len(shape)==1):
+			return arr
+		#Nesting makes a list per row; with no items, nothing above bounds
+		#how many rows a shape like (30000000, 0) has.
+		rows=reduce(operator.mul, itertools.takewhile(bool, shape[:-1]), 1)
+		if rows>max(len(arr), cls.EMPTY_ROWS):
+			raise ValueError('Packed sequence of shape %r has %d items'%(shape, len(arr)))
+		return Nest(arr.tolist(), shape)
 	@classmethod
 	def Deserialize(cls, fin):
-		l=IntSerializer.Deserialize(fin)
-		tp=cls.SEQ_TYPE_MAP[ByteSerializer.Deserialize(fin)]
+		l=ReadLength(fin)
+		seqid=ByteSerializer.Deserialize(fin)
+		if seqid>=cls.PACKED_LIST:
+			return cls.Unpack(seqid, fin)
+		tp=cls.SEQ_TYPE_MAP[seqid]
 		ret=[]
 		for i in xrange(l):
-			ret.append(Deserialize(fin))
+			ret.append(ReadObject(fin))
 		if tp is list:
 			return ret
 		return tp(ret)
@@ -215,12 +615,12 @@ class MapSerializer(BaseSerializer):
 	__tag__=TAG.MAP
 	@classmethod
 	def Serialize(cls, obj, fout):
-		IntSerializer.Serialize(len(obj), fout)
+		WriteLength(len(obj), fout)
 		for pair in sorted(obj.items(), key=lambda item: item[0]):
 			SequenceSerializer.Serialize(pair, fout)
 	@classmethod
 	def Deserialize(cls, fin):
-		l=IntSerializer.Deserialize(fin)
+		l=ReadLength(fin)
 		ret={}
 		for i in xrange(l):
 			key, val=SequenceSerializer.Deserialize(fin)
@@ -234,10 +634,10 @@ class ByteSerializer(BaseSerializer):
 	__tag__=TAG.BYTE
 	@classmethod
 	def Serialize(cls, obj, fout):
-		fout.write(struct.pack('!B', obj))
+		fout.write(chr(obj))
 	@classmethod
 	def Deserialize(cls, fin):
-		return struct.unpack('!B', fin.read(struct.calcsize('!B')))[0]
+		return ord(fin.read(1))
 
 class NoneSerializer(BaseSerializer):
 	__types__=(type(None),)
@@ -254,11 +654,19 @@ class SliceSerializer(BaseSerializer):
 	__tag__=TAG.SLICE
 	@classmethod
 	def Serialize(cls, obj, fout):
-		IntSerializer.Serialize(obj.start, fout)
-		IntSerializer.Serialize(obj.stop, fout)
-		IntSerializer.Serialize(obj.step, fout)
+		if fout.format>=FORMAT.COMPACT:
+			#Fully tagged, so omitted bounds (None) survive.
+			WriteObject(obj.start, fout)
+			WriteObject(obj.stop, fout)
+			WriteObject(obj.step, fout)
+		else:
+			IntSerializer.Serialize(obj.start, fout)
+			IntSerializer.Serialize(obj.stop, fout)
+			IntSerializer.Serialize(obj.step, fout)
 	@classmethod
 	def Deserialize(cls, fin):
+		if fin.format>=FORMAT.COMPACT:
+			return slice(ReadObject(fin), ReadObject(fin), ReadObject(fin))
 		return slice(IntSerializer.Deserialize(fin),
 					IntSerializer.Deserialize(fin),
 					IntSerializer.Deserialize(fin))
@@ -293,35 +701,207 @@ class ErrorSerializer(BaseSerializer):
 		else:
 			return RemoteException(ename, *args)
 
+VALUE_TYPES={} #name -> class declared with ValueType
+VALUE_NAMES={} #class declared with ValueType -> name
+RECORD_TYPES={} #(name, fields) -> namedtuple class made for a received one
+RECORD_TYPES_MAX=1024 #...which is forgotten when it gets this big
+
+def ValueType(cls, name=None):
+	#Declares that instances of cls (and its subclasses) are sent by value:
+	#as the state that __getstate__ returns or, failing that, the attributes
+	#in __slots__ or __dict__. The receiver rebuilds them as the class it has
+	#declared under the same name (by default, module.Class), with
+	#__setstate__ or setattr, without calling __init__; a receiver that hasn't
+	#declared it gets a Record. Returns cls, so this may decorate a class.
+	name=name or cls.__module__+'.'+cls.__name__
+	VALUE_TYPES[name]=cls
+	VALUE_NAMES[cls]=name
+	SetSerializer(cls, ValueSerializer)
+	return cls
+
+class ByValue(object):
+	#Wraps one object to send it by value, as if its class were a ValueType.
+	__slots__=('obj',)
+	def __init__(self, obj):
+		self.obj=obj
+
+class Record(object):
+	#A value of a class not declared here: its state, as attributes, and the
+	#name it was sent under, as __type__.
+	def __init__(self, name, state):
+		self.__type__=name
+		if isinstance(state, dict):
+			self.__dict__.update(state)
+		else:
+			self.state=state
+	def __repr__(self):
+		return '<Record %s %r>'%(self.__type__, dict((k, v) for k, v in self.__dict__.iteritems() if k!='__type__'))
+
+def IsNamedTuple(tp):
+	return issubclass(tp, tuple) and isinstance(getattr(tp, '_fields', None), tuple)
+
+class ValueSerializer(object):
+	#Not a BaseSerializer, as its tag is fixed and it has no __types__ of its
+	#own; ValueType and FindSerializer send it what it takes. Peers that
+	#predate FORMAT.VALUES get whatever they got before (see Fallback).
+	__tag__=TAG.VALUE
+	FROZENSET=0
+	RECORD=1 #A namedtuple: its name, fields and values
+	OBJECT=2 #A ValueType: its name and state
+	@classmethod
+	def Fallback(cls, obj):
+		#Returns (serializer, obj) to send obj with below FORMAT.VALUES.
+		if IsNamedTuple(type(obj)):
+			return SequenceSerializer, tuple(obj)
+		if isinstance(obj, ByValue):
+			obj=obj.obj
+		return SERIALIZERS.get(object), obj
+	@classmethod
+	def Serialize(cls, obj, fout):
+		if isinstance(obj, frozenset):
+			ByteSerializer.Serialize(cls.FROZENSET, fout)
+			WriteLength(len(obj), fout)
+			for item in obj:
+				WriteObject(item, fout)
+			return
+		tp=type(obj)
+		if IsNamedTuple(tp):
+			ByteSerializer.Serialize(cls.RECORD, fout)
+			BytesSerializer.Serialize(tp.__name__, fout)
+			WriteLength(len(obj), fout)
+			for field, item in zip(tp._fields, obj):
+				BytesSerializer.Serialize(field, fout)
+				WriteObject(item, fout)
+			return
+		if isinstance(obj, ByValue):
+			obj=obj.obj
+			tp=type(obj)
+		name=None
+		for base in tp.mro():
+			name=VALUE_NAMES.get(base)
+			if name is not None:
+				break
+		ByteSerializer.Serialize(cls.OBJECT, fout)
+		BytesSerializer.Serialize(name or tp.__module__+'.'+tp.__name__, fout)
+		WriteObject(cls.GetState(obj), fout)
+	@classmethod
+	def GetState(cls, obj):
+		if hasattr(obj, '__getstate__'):
+			return obj.__getstate__()
+		state=dict(getattr(obj, '__dict__', ()))
+		for tp in type(obj).mro():
+			for slot in getattr(tp, '__slots__', ()):
+				if hasattr(obj, slot) and slot not in ('__dict__', '__weakref__'):
+					state[slot]=getattr(obj, slot)
+		return state
+	@classmethod
+	def Deserialize(cls, fin):
+		kind=ByteSerializer.Deserialize(fin)
+		if kind==cls.FROZENSET:
+			return frozenset([ReadObject(fin) for i in xrange(ReadLength(fin))])
+		name=BytesSerializer.Deserialize(fin)
+		if kind==cls.RECORD:
+			items=[(BytesSerializer.Deserialize(fin), ReadObject(fin)) for i in xrange(ReadLength(fin))]
+			fields=tuple(field for field, item in items)
+			return cls.RecordType(name, fields)(*[item for field, item in items])
+		if kind!=cls.OBJECT:
+			raise ValueError('Unknown kind of value %d'%(kind,))
+		state=ReadObject(fin)
+		tp=VALUE_TYPES.get(name)
+		if tp is None:
+			return Record(name, state)
+		obj=tp.__new__(tp)
+		if hasattr(obj, '__setstate__'):
+			obj.__setstate__(state)
+		else:
+			for attr, value in state.iteritems():
+				if isinstance(attr, str) and not attr.startswith('__'):
+					setattr(obj, attr, value)
+		return obj
+	@classmethod
+	def RecordType(cls, name, fields):
+		#The namedtuple declared under name, if it has these fields; else
+		#one made for them.
+		tp=VALUE_TYPES.get(name)
+		if tp is not None and getattr(tp, '_fields', None)==fields:
+			return tp
+		key=(name, fields)
+		tp=RECORD_TYPES.get(key)
+		if tp is None:
+			if len(RECORD_TYPES)>=RECORD_TYPES_MAX:
+				RECORD_TYPES.clear()
+			tp=RECORD_TYPES[key]=collections.namedtuple(name, fields)
+		return tp
+SetSerializer(frozenset, ValueSerializer)
+SetSerializer(ByValue, ValueSerializer)
+
 def Serialize(obj, stream=None):
-	if not stream:
-		stream=cStringIO.StringIO()
+	#Serializers recurse through here with a Writer; copying the buffer out
+	#each time would make containers quadratic, so only plain streams get it.
+	if isinstance(stream, Writer):
+		WriteObject(obj, stream)
+		return
+	fout=Writer(stream=stream)
+	WriteObject(obj, fout)
+	return fout.getvalue() #Not accurate unless stream=None (or empty) on entry.
+
+def Deserialize(stream):
+	if isinstance(stream, (str, buffer, bytearray)):
+		stream=Reader(stream)
+	elif not isinstance(stream, Reader):
+		stream=Reader(stream=stream)
+	return ReadObject(stream)
+
+#Serialize and Deserialize for the serializers of containers, which already
+#have a Writer or Reader.
+def WriteObject(obj, fout):
 	se=GetIdealSerializer(obj)
+	if se is ValueSerializer and fout.format<FORMAT.VALUES:
+		se, obj=ValueSerializer.Fallback(obj)
 	if se is None:
 		raise TypeError('Unserializeable type: '+repr(type(obj)))
-	ByteSerializer.Serialize(se.__tag__, stream)
-	se.Serialize(obj, stream)
-	return stream.getvalue() #Not accurate unless stream=None (or empty) on entry.
+	fout.write(chr(se.__tag__))
+	se.Serialize(obj, fout)
 
-def Deserialize(stream):
-	if isinstance(stream, str):
-		stream=cStringIO.StringIO(stream)
-	tag=ByteSerializer.Deserialize(stream)
-	se=TAGS[tag]
-	return se.Deserialize(stream)
+def ReadObject(fin):
+	return TAGS[ord(fin.read(1))].Deserialize(fin)
 
 def GetIdealSerializer(obj):
 	#Returns a serializer with the "best" (most specific) serializer type for
-	#that object. It does so by comparing MROs--types with longer MROs are
-	#assumed to be more specific, and thus desirable for serialization.
+	#that object. The choice depends only on the object's type, so it is
+	#memoized in CACHE; old-style instances all share one type, and are
+	#always looked up the slow way.
+	tp=type(obj)
+	try:
+		return CACHE[tp]
+	except KeyError:
+		pass
+	if tp is types.InstanceType:
+		return FindSerializer(obj.__class__, obj)
+	gen=GENERATION[0]
+	ser=FindSerializer(tp)
+	if gen==GENERATION[0]: #Don't cache a result computed from stale tables
+		CACHE[tp]=ser
+	return ser
+
+def FindSerializer(tp, obj=None):
+	#Comparing MROs--types with longer MROs are assumed to be more specific,
+	#and thus desirable for serialization.
 	#XXX is this always the case in multiple inheritance situations? If not,
 	#a user can pull the desired serializer from SERIALIZERS manually, or by
 	#referring to it wherever it's defined...
+	try:
+		return SERIALIZERS[tp] #An exact match is always the most specific.
+	except KeyError:
+		pass
+	if IsNamedTuple(tp):
+		return ValueSerializer
 	curser=None
 	curmrolen=0
-	for tp, ser in SERIALIZERS.iteritems():
-		if isinstance(obj, tp):
-			if len(tp.mro())>curmrolen:
+	for stp, ser in SERIALIZERS.items():
+		if issubclass(tp, stp) or (obj is not None and isinstance(obj, stp)):
+			mrolen=len(stp.mro())
+			if mrolen>curmrolen:
 				curser=ser
-				curmrolen=len(tp.mro())
-	return curser
\ No newline at end of file
+				curmrolen=mrolen
+	return curser
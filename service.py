@@ -18,19 +18,42 @@ no other server threads are running, this provides a safe interface to
 code which may not be thread-safe.
 '''
 
+import os
+import struct
 import threading
 import Queue
+import time
+import heapq
+import random
+import collections
 import socket
 import select
+import errno
+import weakref
+import itertools
 import traceback
+import multiprocessing
+import inspect
 
 import serialize
 import packet
 import proxy
+import cache
+
+SO_REUSEPORT=getattr(socket, 'SO_REUSEPORT', 15) #Python 2 doesn't name Linux's
 
 class NOMError(Exception):
     pass
 
+class ServiceBusy(NOMError):
+	pass
+
+class Timeout(NOMError):
+	pass
+
+class Disconnected(NOMError):
+	pass
+
 class LoggedSocket(object):
 	def __init__(self, sock):
 		self.sock=sock
@@ -38,160 +61,972 @@ class LoggedSocket(object):
 		data, src=self.sock.recvfrom(sz)
 		print src, '->', repr(packet.Packet.FromStr(data))
 		return data, src
+	def recvfrom_into(self, buf, sz=0):
+		size, src=self.sock.recvfrom_into(buf, sz)
+		print src, '->', repr(packet.Packet.FromStr(buffer(buf, 0, size)))
+		return size, src
 	def sendto(self, data, addr):
 		print addr, '<-', repr(packet.Packet.FromStr(data))
 		self.sock.sendto(data, addr)
 	def __getattr__(self, attr):
 		return getattr(self.sock, attr)
 
-class Deferred(object):
-	TIMEOUT=None
-	CONDITION=threading.Condition()
-	WAITING=set()
-	@classmethod
-	def SetTimeout(cls, tmout):
-		cls.TIMEOUT=tmout
-	def __init__(self, filt=None, onwait=None):
-		self.filt=filt
+class LossySocket(object):
+	#Stands in for a socket on a bad network, dropping (and duplicating) a
+	#fraction of the datagrams sent through it. For testing:
+	#	srv.sock=LossySocket(srv.sock, 0.1)
+	def __init__(self, sock, loss=0.1, dup=0.0, rng=None):
+		self.sock=sock
+		self.loss=loss
+		self.dup=dup
+		self.rng=rng or random.Random()
+	def sendto(self, data, addr):
+		if self.rng.random()>=self.loss:
+			self.sock.sendto(data, addr)
+			if self.rng.random()<self.dup:
+				self.sock.sendto(data, addr)
+		return len(data)
+	def __getattr__(self, attr):
+		return getattr(self.sock, attr)
+
+class DeferredResult(object):
+	#A transaction awaiting its reply. The Service routes the reply for its
+	#xid straight to it through Service.outstanding, and only this
+	#transaction's waiter is woken. It doubles as a future: Go() sends the
+	#request and returns immediately, and the result can be collected later,
+	#or handed to callbacks.
+	def __init__(self, srv, xid, onwait=None, cli=None, pkt=None):
 		self.onwait=onwait
-		self.queue=Queue.Queue()
-	def Wait(self):
-		with self.CONDITION:
-			self.Go()
-			while True:
-				self.CONDITION.wait(self.TIMEOUT)
-				catch, res = self.Process()
-				if catch:
-					return res
-			
-	def Go(self):
-		with self.CONDITION:
-			self.WAITING.add(self)
-			if self.onwait:
-				self.onwait()
-	def Process(self):
-		while not self.queue.empty():
-			obj=self.queue.get()
-			if self.filt and self.filt(obj):
-				self.WAITING.discard(self)
-				return (True, obj)
-		return (False, None)
-	def Accept(self, obj):
-		self.queue.put(obj)
-	@classmethod
-	def Wake(cls):
-		with cls.CONDITION:
-			cls.CONDITION.notify_all()
-	@classmethod
-	def SendAll(cls, ev):
-		for inst in cls.WAITING:
-			inst.Accept(ev)
-		cls.Wake()
-		
-class DeferredResult(Deferred):
-	def __init__(self, srv, xid, onwait=None):
-		Deferred.__init__(self, lambda obj, self=self: obj.xid == self.xid, onwait)
 		self.srv=srv
 		self.xid=xid
-		self.result=None
+		self.cli=cli
+		self.pkt=pkt #The request Packet
+		self.data=None #...as encoded by the first send, for resends
+		self.defined=[] #Interned strs the request defines to the peer
+		self.sends=0
+		self.firstat=None #When it was first sent...
+		self.sentat=None #...and last
+		self.retries=0 #Resends since the peer was last heard from
+		self.backoff=0 #Doublings of the peer's timeout
+		self.pending=False #True if the peer said it was still working
+		self.replymsg=None #Fragmented packet number of the reply, if it is one
+		self.progress=False #True if reply fragments came since the last timeout
+		self.deadline=None
+		self.reply=None #The reply Packet
 		self.ready=False
+		self.sent=False
+		self.event=threading.Event()
+		self.lock=threading.Lock()
+		self.callbacks=[]
 	def GetResult(self):
 		if not self.ready:
 			raise RuntimeError('Value not available yet')
-		if self.result.Has('error'):
-			raise self.result.error
+		if self.reply.Has('error'):
+			raise self.reply.error
 		else:
-			return self.result.result
+			return self.reply.result
+	def Go(self):
+		if not self.sent:
+			self.sent=True
+			if self.onwait:
+				self.onwait()
+			elif self.pkt is not None:
+				self.srv.Transmit(self)
+		return self
 	def Wait(self):
 		if not self.ready:
-			#print id(self), 'Waiting on transaction', self.xid
-			self.result=Deferred.Wait(self)
-			#print id(self), 'Transaction complete:', self.xid
-			try:
-				del self.srv.outstanding[self.xid]
-			except KeyError:
-				pass
-			self.ready=True
+			self.Go()
+			self.event.wait()
 		return self.GetResult()
+	def Done(self):
+		return self.ready
+	def Result(self, timeout=None):
+		if timeout is None:
+			return self.Wait()
+		self.Go()
+		if not self.event.wait(timeout):
+			raise Timeout('No reply to transaction %d in %r seconds'%(self.xid, timeout))
+		return self.GetResult()
+	def Error(self, timeout=None):
+		try:
+			self.Result(timeout)
+		except Timeout:
+			raise
+		except Exception, e:
+			return e
+		return None
+	def AddCallback(self, func):
+		#func(self) is called once the reply arrives--on the Service thread,
+		#so it must not block--or right away, if it already has.
+		with self.lock:
+			if not self.ready:
+				self.callbacks.append(func)
+				return
+		self.Fire(func)
+	def Fire(self, func):
+		try:
+			func(self)
+		except Exception:
+			print 'Exception encountered in transaction callback:'
+			traceback.print_exc()
 	def Accept(self, obj):
-		if self.filt(obj):
-			#print id(self), 'Accepted object'
-			self.result=obj
+		with self.lock:
+			self.reply=obj
 			self.ready=True
-		Deferred.Accept(self, obj)
-		
+			callbacks, self.callbacks=self.callbacks, []
+		self.event.set()
+		for func in callbacks:
+			self.Fire(func)
+	#The concurrent.futures spellings, for code written against those.
+	result=Result
+	done=Done
+	exception=Error
+	add_done_callback=AddCallback
+
+def Gather(acts, window=None, timeout=None):
+	#Sends every DeferredResult in acts (keeping at most window of them in
+	#flight, if given) and returns their results in order. The first error
+	#is raised once all have finished.
+	acts=list(acts)
+	if window is None:
+		for act in acts:
+			act.Go()
+	else:
+		pending=collections.deque(acts)
+		lock=threading.Lock()
+		def Next(done=None):
+			with lock:
+				act=(pending.popleft() if pending else None)
+			if act is not None:
+				act.AddCallback(Next)
+				act.Go()
+		for i in xrange(min(window, len(acts))):
+			Next()
+	results=[]
+	error=None
+	for act in acts:
+		try:
+			results.append(act.Result(timeout))
+		except Timeout:
+			raise
+		except Exception, e:
+			results.append(None)
+			if error is None:
+				error=e
+	if error is not None:
+		raise error
+	return results
+
+class BatchResult(object):
+	#Stands in for the result of one operation in a Batch until it's flushed.
+	def __init__(self):
+		self.ready=False
+		self.ok=False
+		self.value=None
+	def Set(self, ok, value):
+		self.ok=ok
+		self.value=value
+		self.ready=True
+	def Done(self):
+		return self.ready
+	def Result(self):
+		if not self.ready:
+			raise RuntimeError('Value not available yet; flush the Batch first')
+		if not self.ok:
+			raise self.value
+		return self.value
+	def Error(self):
+		if not self.ready:
+			raise RuntimeError('Value not available yet; flush the Batch first')
+		return (None if self.ok else self.value)
+
+class Batch(object):
+	#Collects pulls on a Client's objects and sends them all in one BATCH
+	#packet, answered with one reply. Operations on proxies from Bind()
+	#return BatchResults, filled in by Flush(), which leaving a with block
+	#does for you:
+	#	with cli.Batch() as b:
+	#		obj=b.Bind(proxy)
+	#		x, y=obj.x, obj.y
+	#	print x.Result(), y.Result()
+	def __init__(self, cli):
+		self.cli=cli
+		self.ops=[]
+		self.results=[]
+	def Bind(self, prx):
+		ref=(prx._obj if isinstance(prx, proxy.Proxy) else None)
+		if getattr(ref, 'cli', None) is not self.cli:
+			raise ValueError('Batched proxies must all refer to objects on the same Client')
+		return proxy.Proxy(BatchReference(self, ref.oid))
+	def Add(self, op, oid, **kwargs):
+		kwargs['op']=op
+		kwargs['oid']=oid
+		self.ops.append(kwargs)
+		res=BatchResult()
+		self.results.append(res)
+		return res
+	def Flush(self):
+		ops, self.ops=self.ops, []
+		results, self.results=self.results, []
+		if not ops:
+			return
+		srv=self.cli.srv
+		if self.cli.format>=serialize.FORMAT.COMPACT:
+			replies=srv.SendPacket(self.cli, _cmd=CMD.BATCH, ops=ops).Wait()
+		else:
+			#Peers that predate formats don't know BATCH either; pipeline
+			#the operations instead.
+			acts=[srv.SendPacket(self.cli, **op).Go() for op in ops]
+			replies=[]
+			for act in acts:
+				try:
+					replies.append((True, act.Wait()))
+				except Exception, e:
+					replies.append((False, e))
+		for res, (ok, value) in zip(results, replies):
+			res.Set(ok, value)
+	def __enter__(self):
+		return self
+	def __exit__(self, tp, val, tb):
+		if tp is None:
+			self.Flush()
+
+class BatchReference(object):
+	#The RemoteReference interface, queueing operations into a Batch.
+	def __init__(self, batch, oid):
+		self.batch=batch
+		self.oid=oid
+	def GetAttr(self, attr):
+		return self.batch.Add('GetAttr', self.oid, attr=attr)
+	def SetAttr(self, attr, val):
+		return self.batch.Add('SetAttr', self.oid, attr=attr, val=val)
+	def DelAttr(self, attr):
+		return self.batch.Add('DelAttr', self.oid, attr=attr)
+	def GetItem(self, item):
+		return self.batch.Add('GetItem', self.oid, item=item)
+	def SetItem(self, item, val):
+		return self.batch.Add('SetItem', self.oid, item=item, val=val)
+	def DelItem(self, item):
+		return self.batch.Add('DelItem', self.oid, item=item)
+	def Len(self):
+		return self.batch.Add('Len', self.oid)
+	def Repr(self):
+		return self.batch.Add('Repr', self.oid)
+	def Str(self):
+		return self.batch.Add('Str', self.oid)
+	def Call(self, *args, **kwargs):
+		return self.batch.Add('Call', self.oid, args=args, kwargs=kwargs)
+
+class RemoteIterator(object):
+	#Iterates over a remote object a chunk at a time. The first chunk comes
+	#back with the iterator, which the owning Service holds (as any object it
+	#sends) until this is done with it; each later chunk is asked for as soon
+	#as the one before it arrives, so it is on its way while that one is
+	#consumed. Chunks double from CHUNK items up to CHUNK_MAX. Peers that
+	#predate Iter are iterated the old way, an item (and pull) at a time.
+	CHUNK=64
+	CHUNK_MAX=8192
+	def __init__(self, ref):
+		self.srv=ref.srv
+		self.cli=ref.cli
+		self.count=self.CHUNK
+		self.pending=None #DeferredResult of the next chunk
+		try:
+			items, self.remote=self.srv.Iter(self.cli, ref.oid, self.count).Wait()
+		except NameError:
+			items, self.remote=self.Indexed(ref), None
+		self.items=iter(items)
+		self.Prefetch()
+	def Indexed(self, ref):
+		index=0
+		while True:
+			try:
+				yield ref.GetItem(index)
+			except IndexError:
+				return
+			index+=1
+	def Prefetch(self):
+		if self.remote is not None:
+			self.count=min(self.count*2, self.CHUNK_MAX)
+			self.pending=self.srv.Next(self.cli, self.remote._obj.oid, self.count).Go()
+	def __iter__(self):
+		return self
+	def next(self):
+		while True:
+			try:
+				return self.items.next()
+			except StopIteration:
+				pass
+			if self.pending is None:
+				raise StopIteration
+			act, self.pending=self.pending, None
+			items=act.Wait()
+			if len(items)<self.count:
+				self.remote=None #Lets the owner drop the iterator
+			self.items=iter(items)
+			self.Prefetch()
+
+def Cache(prx, policy):
+	#Sets the cache.Policy (or None) of the reference behind prx. References
+	#are shared per remote object, so this applies to every proxy of it.
+	prx._obj.SetCache(policy)
+
+def NonBlocking(prx):
+	#A proxy for the same remote object as prx whose operations return
+	#DeferredResults instead of waiting for them.
+	ref=prx._obj
+	if isinstance(ref, MethodReference):
+		nb=MethodReference(ref.ref, ref.name)
+	else:
+		nb=RemoteReference(ref.srv, ref.cli, ref.oid)
+		nb.methods=ref.methods
+	nb.blocking=False
+	nb.shared=ref #The object stays held (see RefHandle) as long as nb is around
+	return proxy.Proxy(nb)
+
+def Pipelined(prx):
+	#A proxy for the same object as prx whose operations return Promises (in
+	#proxies) without waiting, so that whole chains of them, like
+	#Pipelined(obj).b().c().a(), take one round trip.
+	ref=prx._obj
+	root=(ref.ref.oid if isinstance(ref, MethodReference) else ref.oid)
+	return proxy.Proxy(Promise(ref.srv, ref.cli, root, value=prx))
+
+def Await(prx, timeout=None):
+	#The result of the Promise behind prx, once it comes.
+	return prx._obj.Result(timeout)
+
+class Promise(object):
+	#The RemoteReference interface to the result of a pull that may not have
+	#been answered yet. Operations on it are sent at once, naming that pull
+	#by its xid (as on) in place of an object; the peer keeps the results of
+	#such pulls (see Service.Keep) and runs the next on the result as soon as
+	#it has it. The oid sent with them is the root of the chain, which shows
+	#a sharded peer where to run it. Peers that predate FORMAT.PROMISES are
+	#sent each pull when the one before it is answered, and operations on
+	#results that came back as values are done here.
+	#
+	#A Promise holds the one it acts on, so a kept result is released (see
+	#KeptHandle) once nothing can act on it any more.
+	FIELDS={
+		'GetAttr': ('attr',), 'SetAttr': ('attr', 'val'), 'DelAttr': ('attr',),
+		'GetItem': ('item',), 'SetItem': ('item', 'val'), 'DelItem': ('item',),
+		'Len': (), 'Repr': (), 'Str': (), 'Call': ('args', 'kwargs'),
+	}
+	def __init__(self, srv, cli, root, act=None, value=None, on=None):
+		self.srv=srv
+		self.cli=cli
+		self.root=root #OID the chain started from
+		self.act=act #DeferredResult of the pull, or None if value is known
+		self.value=value
+		self.on=on #The Promise whose result this acts on, if it's kept
+	def Result(self, timeout=None):
+		if self.act is None:
+			return self.value
+		return self.act.Result(timeout)
+	def Done(self):
+		return self.act is None or self.act.Done()
+	def Chain(self, op, *args):
+		#Sends op, with the fields (in FIELDS) args, for this result.
+		fields=dict(zip(self.FIELDS[op], args))
+		if self.act is not None and self.cli.format>=serialize.FORMAT.PROMISES:
+			act=self.srv.SendPacket(self.cli, op=op, oid=self.root, on=self.act.xid, keep=True, **fields).Go()
+			return proxy.Proxy(self.srv.Keeping(Promise(self.srv, self.cli, self.root, act, on=self)))
+		target=self.Result()
+		ref=(target._obj if isinstance(target, proxy.Proxy) else None)
+		if isinstance(ref, RemoteReference) and op=='GetAttr' and ref.methods is not None and args[0] in ref.methods:
+			return proxy.Proxy(Promise(self.srv, self.cli, self.root, value=proxy.Proxy(MethodReference(ref, args[0]))))
+		if isinstance(ref, MethodReference) and op=='Call':
+			ref, op, fields['attr']=ref.ref, 'CallMethod', ref.name
+		if isinstance(ref, RemoteReference):
+			if ref.cli.format<serialize.FORMAT.PROMISES:
+				act=self.srv.SendPacket(ref.cli, op=op, oid=ref.oid, **fields).Go()
+				return proxy.Proxy(Promise(ref.srv, ref.cli, ref.oid, act))
+			act=self.srv.SendPacket(ref.cli, op=op, oid=ref.oid, keep=True, **fields).Go()
+			return proxy.Proxy(ref.srv.Keeping(Promise(ref.srv, ref.cli, ref.oid, act)))
+		local=proxy.ReverseProxy(target)
+		if op=='Call':
+			value=local.Call(*args[0], **args[1])
+		else:
+			value=getattr(local, op)(*args)
+		return proxy.Proxy(Promise(self.srv, self.cli, self.root, value=value))
+	def GetAttr(self, attr):
+		return self.Chain('GetAttr', attr)
+	def SetAttr(self, attr, val):
+		return self.Chain('SetAttr', attr, val)
+	def DelAttr(self, attr):
+		return self.Chain('DelAttr', attr)
+	def GetItem(self, item):
+		return self.Chain('GetItem', item)
+	def SetItem(self, item, val):
+		return self.Chain('SetItem', item, val)
+	def DelItem(self, item):
+		return self.Chain('DelItem', item)
+	#These must return what the built-ins expect, so they wait.
+	def Len(self):
+		return Await(self.Chain('Len'))
+	def Iter(self):
+		return iter(self.Result())
+	def Repr(self):
+		return Await(self.Chain('Repr'))
+	def Str(self):
+		return Await(self.Chain('Str'))
+	def Call(self, *args, **kwargs):
+		return self.Chain('Call', args, kwargs)
+
+class WorkerPool(object):
+	#A bounded set of worker threads, started on demand, fed from a bounded
+	#queue. Submit() returns False instead of blocking when the queue is full.
+	#Jobs submitted with the same lane run one at a time, in order, without
+	#tying up more than one worker.
+	def __init__(self, workers, depth):
+		self.workers=workers
+		self.depth=depth
+		self.jobs=collections.deque() #(func, args) waiting for a worker
+		self.lock=threading.Lock()
+		self.ready=threading.Condition(self.lock)
+		self.threads=[]
+		self.idle=0 #Workers waiting for a job
+		self.lanes={} #lane -> deque of (func, args)
+	def Submit(self, func, args=(), lane=None):
+		with self.lock:
+			if lane is None:
+				if len(self.jobs)>=self.depth:
+					return False
+				self.jobs.append((func, args))
+			elif lane in self.lanes:
+				if len(self.lanes[lane])>=self.depth:
+					return False
+				self.lanes[lane].append((func, args))
+				return True
+			else:
+				if len(self.jobs)>=self.depth:
+					return False
+				self.jobs.append((self.Drain, (lane,)))
+				self.lanes[lane]=collections.deque([(func, args)])
+			self.ready.notify()
+			#Workers take jobs and stop being idle in one step, under the lock,
+			#so a worker that has just taken a job is never counted on for
+			#this one.
+			if len(self.jobs)>self.idle and len(self.threads)<self.workers:
+				th=threading.Thread(target=self.Work)
+				th.daemon=True
+				self.threads.append(th)
+				th.start()
+		return True
+	def Drain(self, lane):
+		while True:
+			with self.lock:
+				jobs=self.lanes[lane]
+				if not jobs:
+					del self.lanes[lane]
+					return
+				func, args=jobs.popleft()
+			self.Run(func, args)
+	def Work(self):
+		while True:
+			with self.lock:
+				self.idle+=1
+				while not self.jobs:
+					self.ready.wait()
+				self.idle-=1
+				func, args=self.jobs.popleft()
+			self.Run(func, args)
+	def Run(self, func, args):
+		try:
+			func(*args)
+		except Exception:
+			print 'Exception encountered in worker:'
+			traceback.print_exc()
+
+class Pacer(object):
+	#A token bucket: Take(n) returns once n more bytes may be sent without
+	#exceeding rate bytes per second, after an initial burst.
+	def __init__(self, rate, burst):
+		self.rate=rate
+		self.burst=burst
+		self.tokens=burst
+		self.stamp=time.time()
+		self.lock=threading.Lock()
+	def Take(self, n):
+		with self.lock:
+			now=time.time()
+			self.tokens=min(self.burst, self.tokens+(now-self.stamp)*self.rate)
+			self.stamp=now
+			self.tokens-=n
+			delay=-self.tokens/self.rate
+		if delay>0:
+			time.sleep(delay)
+
+class DatagramTransport(object):
+	#The Service's own UDP socket, shared by every peer that uses it. Packets
+	#bigger than Service.FRAGMENT are split, and unanswered requests resent.
+	#
+	#A transport is chosen per peer in Service.Connect. Any class with this
+	#interface will do: Open(srv, addr) returns the transport to use for the
+	#peer at addr, Send(datagrams, addr) sends packets, and, once the Service
+	#is polling it, Receive() returns the (data, addr) packets that have
+	#arrived; data may be a buffer that the next Receive() overwrites.
+	#RELIABLE transports see to delivery themselves.
+	RELIABLE=False
+	def __init__(self, srv, sock=None):
+		self.srv=srv
+		self.sock=sock #If None, the Service's, whatever it is at the time
+		self.buf=bytearray(srv.BUFSIZE) #Every datagram is received into this
+	@classmethod
+	def Open(cls, srv, addr):
+		return srv.udp
+	def fileno(self):
+		return (self.sock or self.srv.sock).fileno()
+	def Send(self, datagrams, addr):
+		#Fragments are paced, so that a big packet doesn't overrun the
+		#socket buffers at either end.
+		sock=self.sock or self.srv.sock
+		if len(datagrams)==1:
+			sock.sendto(datagrams[0], addr)
+			return
+		for data in datagrams:
+			self.srv.pacer.Take(len(data))
+			sock.sendto(data, addr)
+	def Receive(self):
+		#recvfrom would allocate BUFSIZE bytes for each datagram, only to
+		#shrink them; packets are parsed where they land instead.
+		try:
+			size, src=(self.sock or self.srv.sock).recvfrom_into(self.buf)
+		except socket.timeout:
+			return []
+		return [(buffer(self.buf, 0, size), src)]
+	def Close(self):
+		pass
+
+class StreamTransport(object):
+	#One TCP connection to a peer. Packets go whole, each after its length as
+	#a 4-byte prefix, and nothing is resent. The connecting side's first
+	#packet is its Service's port, which is how the other side knows it.
+	#
+	#The socket doesn't block. Packets sent are queued, and written as the
+	#socket takes them: at once, and then by the Service thread whenever the
+	#Poller finds it writable, so that thread never waits on a slow peer.
+	#Other threads wait to send while more than BACKLOG bytes are queued; the
+	#Service thread drops a peer that far behind instead.
+	RELIABLE=True
+	PREFIX=struct.Struct('!L')
+	NODELAY=True #Packets are written whole, so Nagle's algorithm only delays them
+	BACKLOG=1<<24 #Most bytes queued for the peer (see above)
+	def __init__(self, srv, sock, addr=None):
+		self.srv=srv
+		self.sock=sock
+		self.addr=addr #The peer's Service address, once known
+		self.lock=threading.Lock()
+		self.drained=threading.Condition(self.lock) #Notified as queued drops below BACKLOG
+		self.out=collections.deque() #Packets queued to write...
+		self.offset=0 #...how much of the first is written...
+		self.queued=0 #...and how many bytes are left
+		self.writing=False #Whether the Poller is watching for the socket to be writable
+		self.closed=False
+		self.chunks=[] #Bytes received and not yet returned...
+		self.have=0 #...how many there are...
+		self.need=None #...and how many the next packet takes, once known
+		if self.NODELAY:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.setblocking(False)
+	@classmethod
+	def Open(cls, srv, addr):
+		stream=cls(srv, socket.create_connection(addr), addr)
+		srv.poller.Add(stream)
+		stream.Send([serialize.Serialize(list(srv.addr))], addr)
+		return stream
+	def fileno(self):
+		return self.sock.fileno()
+	def Send(self, datagrams, addr):
+		with self.lock:
+			if self.queued>self.BACKLOG:
+				if threading.current_thread() is self.srv:
+					self.Break()
+				while self.queued>self.BACKLOG and not self.closed:
+					self.drained.wait()
+			if self.closed:
+				if threading.current_thread() is self.srv:
+					return #The Poller sees it closed, and the Service loses it
+				raise socket.error(errno.EPIPE, 'Connection to %r closed'%(self.addr,))
+			for data in datagrams:
+				self.out.append(self.PREFIX.pack(len(data))+data)
+				self.queued+=self.PREFIX.size+len(data)
+			self.Write()
+	def Flush(self):
+		#The Poller found the socket writable.
+		with self.lock:
+			self.Write()
+	def Write(self):
+		#Writes what the socket takes of the queue, under the lock.
+		while self.out and not self.closed:
+			try:
+				sent=self.sock.send(buffer(self.out[0], self.offset))
+			except socket.error, e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				self.Break()
+				break
+			self.offset+=sent
+			self.queued-=sent
+			if self.offset==len(self.out[0]):
+				self.out.popleft()
+				self.offset=0
+		if self.queued<=self.BACKLOG:
+			self.drained.notify_all()
+		if bool(self.out)!=self.writing and not self.closed:
+			self.writing=bool(self.out)
+			self.srv.poller.Writable(self, self.writing)
+	def Break(self):
+		#Gives up on the connection, under the lock; reading it then fails,
+		#and the Service loses it (see Service.Lost).
+		self.closed=True
+		self.out.clear()
+		self.queued=0
+		self.drained.notify_all()
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+	def Receive(self):
+		try:
+			data=self.sock.recv(self.srv.BUFSIZE)
+		except socket.error, e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return []
+			raise
+		if not data:
+			raise EOFError('Connection closed')
+		self.chunks.append(data)
+		self.have+=len(data)
+		packets=[]
+		while True:
+			if self.need is None:
+				if self.have<self.PREFIX.size:
+					break
+				buf=''.join(self.chunks)
+				self.need=self.PREFIX.unpack_from(buf)[0]
+				if self.need>self.srv.REASSEMBLY_BYTES:
+					raise EOFError('Packet of %d bytes is too long'%(self.need,))
+				self.chunks=[buf[self.PREFIX.size:]]
+				self.have-=self.PREFIX.size
+			if self.have<self.need:
+				break
+			buf=''.join(self.chunks)
+			packets.append(buf[:self.need])
+			self.chunks=[buf[self.need:]]
+			self.have-=self.need
+			self.need=None
+		if self.addr is None and packets:
+			self.Greet(packets.pop(0))
+		return [(raw, self.addr) for raw in packets]
+	def Greet(self, data):
+		#Only the port is taken from the greeting. The host is the one the
+		#connection comes from, so a peer can't pass itself off as another
+		#host's Service, and take over its replies.
+		#Anything else is a bad connection, which is dropped like a closed one.
+		try:
+			host, port=serialize.Deserialize(data)
+			port=int(port)
+		except Exception:
+			raise EOFError('Bad greeting %r'%(data[:64],))
+		self.addr=(self.sock.getpeername()[0], port)
+		self.srv.GetClient(self.addr).transport=self
+	def Close(self):
+		with self.lock:
+			self.closed=True
+			self.drained.notify_all()
+		self.sock.close()
+
+class StreamListener(object):
+	#Accepts TCP connections for a Service, polled like a transport.
+	RELIABLE=False
+	def __init__(self, srv, addr):
+		self.srv=srv
+		self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if srv.shard is not None:
+			self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+		self.sock.bind(addr)
+		self.sock.listen(socket.SOMAXCONN)
+	def fileno(self):
+		return self.sock.fileno()
+	def Receive(self):
+		try:
+			sock, src=self.sock.accept()
+		except socket.error:
+			print 'Exception encountered accepting connection:'
+			traceback.print_exc()
+			return []
+		self.srv.poller.Add(StreamTransport(self.srv, sock))
+		return []
+
+class Poller(object):
+	#Waits for any of a set of transports to have something to read: with
+	#epoll where there is one, otherwise with select, and a pipe to wake it
+	#when the set changes.
+	def __init__(self):
+		self.handlers={} #fileno -> transport
+		self.writers=set() #filenos of those to report when writable
+		self.epoll=(select.epoll() if hasattr(select, 'epoll') else None)
+		if self.epoll is None:
+			self.wakerd, self.wakewr=os.pipe()
+	def Add(self, handler):
+		fd=handler.fileno()
+		self.handlers[fd]=handler
+		if self.epoll is not None:
+			self.epoll.register(fd, select.EPOLLIN)
+		else:
+			os.write(self.wakewr, 'x')
+	def Remove(self, handler):
+		fd=handler.fileno()
+		self.writers.discard(fd)
+		if self.handlers.pop(fd, None) is not None and self.epoll is not None:
+			self.epoll.unregister(fd)
+	def Writable(self, handler, on):
+		#Whether to also report handler (with Flush) when it can be written to.
+		fd=handler.fileno()
+		if fd not in self.handlers:
+			return
+		(self.writers.add if on else self.writers.discard)(fd)
+		if self.epoll is not None:
+			try:
+				self.epoll.modify(fd, select.EPOLLIN|(select.EPOLLOUT if on else 0))
+			except (IOError, OSError):
+				pass #Removed meanwhile
+		else:
+			os.write(self.wakewr, 'x')
+	def Poll(self, timeout):
+		#Returns the handlers with something to read, and those writable.
+		if self.epoll is not None:
+			events=self.epoll.poll(timeout)
+			ready=[fd for fd, mask in events if mask&~select.EPOLLOUT]
+			writable=[fd for fd, mask in events if mask&select.EPOLLOUT]
+		else:
+			ready, writable=select.select(self.handlers.keys()+[self.wakerd], list(self.writers), [], timeout)[:2]
+			if self.wakerd in ready:
+				os.read(self.wakerd, 4096)
+		return ([self.handlers[fd] for fd in ready if fd in self.handlers],
+			[self.handlers[fd] for fd in writable if fd in self.handlers])
+
+class Kept(object):
+	#The result of a pipelined pull, and the pulls waiting to act on it.
+	def __init__(self):
+		self.ready=False
+		self.ok=False
+		self.value=None
+		self.size=0 #Bytes its reply took
+		self.waiting=[] #(pkt, cli) of pulls that came before it was ready
+
+class Partial(object):
+	#The fragments of one packet received so far.
+	def __init__(self, count):
+		self.count=count
+		self.parts={} #index -> data
+		self.size=0
+		self.stamp=time.time()
+
+class Retransmitter(threading.Thread):
+	#Resends requests that go unanswered. Each peer's timeout follows its
+	#measured round trip time (Jacobson's estimator, sampling only
+	#transactions that were sent once, per Karn), doubling with each resend
+	#of a transaction. After Service.RETRIES resends without word from the
+	#peer, the transaction fails with Timeout; a peer still working on one
+	#answers resends with a pending reply, which starts the count over.
+	TICK=0.01 #Seconds between checks; a timed Condition.wait polls anyway
+	def __init__(self, srv):
+		threading.Thread.__init__(self)
+		self.daemon=True
+		self.srv=srv
+		self.heap=[] #(deadline, xid, DeferredResult)
+		self.lock=threading.Lock()
+	def Watch(self, act, delay):
+		with self.lock:
+			act.deadline=time.time()+delay
+			heapq.heappush(self.heap, (act.deadline, act.xid, act))
+	def run(self):
+		#Module globals are gone if this wakes during interpreter shutdown.
+		sleep, clock, heappop=time.sleep, time.time, heapq.heappop
+		while True:
+			sleep(self.TICK)
+			now=clock()
+			expired=[]
+			with self.lock:
+				while self.heap and (self.heap[0][0]<=now or self.heap[0][2].ready):
+					expired.append(heappop(self.heap))
+			for deadline, xid, act in expired:
+				if not act.ready and act.deadline==deadline:
+					self.srv.Expired(act)
+
 class ObjectTranslator(object):
+	#Every Service registers one of these for object, but serializers are
+	#process-wide; the Service that owns a packet is found through the peer
+	#its stream is bound to, and self.srv is only the fallback.
 	__tag__=255
 	def __init__(self, srv):
 		self.srv=srv
 	def Serialize(self, obj, fout):
-		self.srv.omap[id(obj)]=obj
-		serialize.LongSerializer.Serialize(id(obj), fout)
-		serialize.SequenceSerializer.Serialize(self.srv.addr, fout)
+		srv=(fout.peer.srv if fout.peer else self.srv)
+		oid=srv.Track(obj)
+		if fout.peer:
+			fout.peer.Hold(oid)
+		if fout.format>=serialize.FORMAT.COMPACT:
+			serialize.WriteVarint(oid, fout)
+		else:
+			serialize.LongSerializer.Serialize(oid, fout)
+		serialize.SequenceSerializer.Serialize(srv.addr, fout)
 	def Deserialize(self, fin):
-		oid=serialize.LongSerializer.Deserialize(fin)
+		srv=(fin.peer.srv if fin.peer else self.srv)
+		if fin.format>=serialize.FORMAT.COMPACT:
+			oid=long(serialize.ReadVarint(fin))
+		else:
+			oid=serialize.LongSerializer.Deserialize(fin)
 		addr=tuple(serialize.SequenceSerializer.Deserialize(fin))
-		if addr==self.srv.addr:
+		if addr!=srv.addr and addr[0] in ('', '0.0.0.0') and fin.peer:
+			#A Service bound to every interface (the default) only knows its
+			#port; the host is the one the reference came from.
+			addr=(fin.peer.addr[0],)+addr[1:]
+		if addr!=srv.addr:
+			cli=(fin.peer if fin.peer and addr==fin.peer.addr else srv.GetClient(addr))
+		elif oid%srv.stride!=srv.stripe:
+			cli=srv.shards[oid%srv.stride] #Another shard's; see Shard
+		else:
 			try:
-				return self.srv.omap[oid]
+				return srv.omap[oid]
 			except KeyError:
 				raise ValueError('Bad OID in serialized data')
-		else:
-			return proxy.Proxy(RemoteReference(self.srv, self.srv.GetClient(addr), oid))
+		#A packet being read by Service.run only counts toward the RELEASE
+		#if it turns out not to be a duplicate; see Service.Count.
+		received=(fin.peer.received if fin.peer else None)
+		ref=srv.GetReference(cli, oid, (1 if received is None else 0))
+		if received is not None:
+			received.append(ref)
+		return proxy.Proxy(ref)
 		
+class RefHandle(weakref.ref):
+	#Weakly refers to the RemoteReference for key=(addr, oid), counting how
+	#many times the peer has sent it; that count goes back in the RELEASE
+	#once the reference is collected.
+	__slots__=('key', 'count')
+
+class KeptHandle(weakref.ref):
+	#Weakly refers to the Promise for the pull key=(addr, xid), whose result
+	#the peer keeps; once the Promise is collected, the xid goes back in the
+	#RELEASE, and the peer drops the result.
+	__slots__=('key',)
+
 class RemoteReference(object):
+	CACHE=None #cache.Policy given to every new reference, if any
 	def __init__(self, srv, cli, oid):
 		self.srv=srv
 		self.cli=cli
 		self.oid=oid
 		self.blocking=True
-		self.pushdata={}
-	def GetAttr(self, attr):
-		if attr in self.pushdata:
-			return self.pushdata[attr]
+		self.methods=None #Names of the object's methods, if the peer said
+		self.bymethod=weakref.WeakValueDictionary() #name -> Method proxy in use
+		self.cache=None
+		self.subscription=None #DeferredResult of the Subscribe pull
+		if self.CACHE is not None:
+			self.SetCache(self.CACHE)
+	def SetCache(self, policy):
+		#This may be called from the Service thread, so it never waits; until
+		#a subscription is confirmed, nothing is cached.
+		if self.subscription is not None:
+			self.srv.SendPacket(self.cli, op='Unsubscribe', oid=self.oid).Go()
+			self.subscription=None
+		self.cache=(None if policy is None else cache.Cache(policy))
+		if policy is not None and policy.SUBSCRIBE:
+			self.subscription=self.srv.SendPacket(self.cli, op='Subscribe', oid=self.oid).Go()
+	def Do(self, act):
 		if self.blocking:
-			return self.srv.GetAttr(self.cli, self.oid, attr).Wait()
-		return self.srv.GetAttr(self.cli, self.oid, attr).Go()
+			return act.Wait()
+		return act.Go()
+	def Cached(self, key, send, *args):
+		hit, value=self.cache.Get(key)
+		if hit:
+			return value
+		gen=self.cache.Generation()
+		value=send(self.cli, self.oid, *args).Wait()
+		sub=self.subscription
+		if sub is None or (sub.Done() and sub.Error() is None):
+			self.cache.Put(key, value, gen)
+		return value
+	def Invalidate(self, key):
+		if self.cache is not None:
+			self.cache.Invalidate(key)
+	def Pushed(self, pkt):
+		#A change to the remote object, pushed by the Service that owns it.
+		if self.cache is None:
+			return
+		key=(cache.LEN_KEY if pkt.Has('len') else cache.AttrKey(pkt.attr))
+		self.cache.Invalidate(key) #Also drops any read still in flight
+		if pkt.Has('val'):
+			self.cache.Put(key, pkt.val)
+	def GetAttr(self, attr):
+		if self.methods is not None and attr in self.methods:
+			return self.Method(attr)
+		if self.cache is not None and self.blocking:
+			return self.Cached(cache.AttrKey(attr), self.srv.GetAttr, attr)
+		return self.Do(self.srv.GetAttr(self.cli, self.oid, attr))
 	def SetAttr(self, attr, val):
-		if self.blocking:
-			self.srv.SetAttr(self.cli, self.oid, attr, val).Wait()
-		else:
-			self.srv.SetAttr(self.cli, self.oid, attr, val).Go()
+		self.Invalidate(cache.AttrKey(attr))
+		return self.Do(self.srv.SetAttr(self.cli, self.oid, attr, val))
 	def DelAttr(self, attr):
-		if self.blocking:
-			self.srv.DelAttr(self.cli, self.oid, attr).Wait()
-		else:
-			self.srv.DelAttr(self.cli, self.oid, attr).Go()
+		self.Invalidate(cache.AttrKey(attr))
+		return self.Do(self.srv.DelAttr(self.cli, self.oid, attr))
 	def GetItem(self, item):
-		if self.blocking:
-			return self.srv.GetItem(self.cli, self.oid, item).Wait()
-		return self.srv.GetItem(self.cli, self.oid, item).Go()
+		return self.Do(self.srv.GetItem(self.cli, self.oid, item))
 	def SetItem(self, item, val):
-		if self.blocking:
-			self.srv.SetItem(self.cli, self.oid, item, val).Wait()
-		else:
-			self.srv.SetItem(self.cli, self.oid, item, val).Go()
+		self.Invalidate(cache.LEN_KEY)
+		return self.Do(self.srv.SetItem(self.cli, self.oid, item, val))
 	def DelItem(self, item):
-		if self.blocking:
-			self.srv.Delitem(self.cli, self.oid, item).Wait()
-		else:
-			self.srv.Delitem(self.cli, self.oid, item).Go()
+		self.Invalidate(cache.LEN_KEY)
+		return self.Do(self.srv.DelItem(self.cli, self.oid, item))
 	def Len(self):
-		if self.blocking:
-			return self.srv.Len(self.cli, self.oid).Wait()
-		return self.srv.Len(self.cli, self.oid).Go()
+		if self.cache is not None and self.blocking:
+			return self.Cached(cache.LEN_KEY, self.srv.Len)
+		return self.Do(self.srv.Len(self.cli, self.oid))
+	def Iter(self):
+		return RemoteIterator(self)
 	def Repr(self):
-		if self.blocking:
-			return self.srv.Repr(self.cli, self.oid).Wait()
-		return self.srv.Repr(self.cli, self.oid).Go()
+		return self.Do(self.srv.Repr(self.cli, self.oid))
 	def Str(self):
-		if self.blocking:
-			return self.srv.Str(self.cli, self.oid).Wait()
-		return self.srv.Str(self.cli, self.oid).Go()
+		return self.Do(self.srv.Str(self.cli, self.oid))
 	def Call(self, *args, **kwargs):
-		if self.blocking:
-			return self.srv.Call(self.cli, self.oid, *args, **kwargs).Wait()
-		return self.srv.Call(self.cli, self.oid, *args, **kwargs).Go()
+		return self.Do(self.srv.Call(self.cli, self.oid, *args, **kwargs))
+	def CallMethod(self, name, *args, **kwargs):
+		return self.Do(self.srv.CallMethod(self.cli, self.oid, name, *args, **kwargs))
+	def Method(self, name):
+		#A proxy for the listed method name (see MethodReference); the same
+		#one, while it's in use, so it fetches the bound method at most once.
+		prx=self.bymethod.get(name)
+		if prx is None:
+			prx=self.bymethod[name]=proxy.Proxy(MethodReference(self, name))
+		return prx
+
+class MethodReference(RemoteReference):
+	#A method of the remote object behind ref, whose peer listed its methods
+	#(see Service.Resolve). Calling it is one CallMethod pull, where getting
+	#the bound method and calling that would be two, and would leave the peer
+	#holding the bound method until this released it. Anything else done with
+	#it, its oid included, gets the bound method first (once) and acts on that.
+	def __init__(self, ref, name):
+		self.ref=ref #The object stays held as long as this is around
+		self.name=name
+		self.srv=ref.srv
+		self.cli=ref.cli
+		self.blocking=ref.blocking
+		self.methods=None
+		self.cache=None
+		self.subscription=None
+		self.bound=None #Proxy for the bound method, once it's needed
+	@property
+	def oid(self):
+		if self.bound is None:
+			self.bound=self.srv.GetAttr(self.cli, self.ref.oid, self.name).Wait()
+		return self.bound._obj.oid
+	def Call(self, *args, **kwargs):
+		return self.Do(self.srv.CallMethod(self.cli, self.ref.oid, self.name, *args, **kwargs))
 		
 class CMD:
 	SYNC=0
@@ -200,18 +1035,188 @@ class CMD:
 	RESOLVE=3
 	LIST=4
 	PUSH=5
+	BATCH=6
+	RELEASE=7
+	FRAGMENT=8
+	RELAY=9
+	EVENT=10
+	SUBSCRIBE=11
 CMD.NAMES=dict(zip(CMD.__dict__.values(), CMD.__dict__.keys()))
 	
+class Shard(object):
+	#Where a Service stands among count processes that share one port with
+	#SO_REUSEPORT (see Serve). The kernel picks a shard for each peer address,
+	#which gets all that peer's packets; OIDs and xids end in their owner's
+	#index (modulo count), and a shard passes a packet for an object (or a
+	#reply to a request) of another to it, through relays: a local UDP socket
+	#for each shard, of which this one reads relays[index]. Shards reach each
+	#other's objects as peers at those addresses.
+	def __init__(self, index, count, sock, relays):
+		self.index=index
+		self.count=count
+		self.sock=sock #Bound to the shared port
+		self.relays=relays #Bound to their own
+		self.addrs=[relay.getsockname() for relay in relays]
+
 class Client(object):
 	def __init__(self, addr, srv=None):
 		self.addr=addr
 		self.srv=srv
+		self.format=serialize.FORMAT.BASE #Agreed at SYNC
+		self.srtt=None #Smoothed round trip time, once measured
+		self.rttvar=None
+		self.rto=None #Retransmission timeout; None until measured
+		shard=(srv.shard if srv is not None else None)
+		if shard is None:
+			self.strings=serialize.StringTable() #Interned with this peer
+		else:
+			self.strings=serialize.StringTable(shard.count, shard.index)
+			self.strings.onassign=lambda index, string: srv.ShareName(self, index, string)
+		self.codec=None #packet.Codec agreed at SYNC, from FORMAT.COMPRESSED
+		self.syncs=0 #SYNCs received from this peer (shards compare them)
+		self.backoff=0 #Doublings of rto since the last reply to a request sent once...
+		self.backedoff=0.0 #...and when a timeout last added one
+		self.received=None #References read from the packet being parsed
+		self.used=None #...and, on a shard, the peer's interned strs in it
+		self.transport=(srv.udp if srv is not None else None)
+		self.outbox=None #Outbox for events, on a RELIABLE transport
 		#Authorizers may add more attributes here
 	def List(self):
 		return self.srv.List(self)
 	def Resolve(self, name):
 		return self.srv.Resolve(self, name)
+	def Batch(self):
+		return Batch(self)
+	def Hold(self, oid):
+		#The peer is sent a reference to oid, which it will release.
+		self.srv.Hold(oid, self.addr)
+	def Subscribe(self, topic, func, multicast=False):
+		return self.srv.Subscribe(self, topic, func, multicast)
+	def Unsubscribe(self, topic, func):
+		return self.srv.Unsubscribe(self, topic, func)
 		
+class Topic(object):
+	#Events a Service publishes to the peers that subscribe to it by name
+	#(see Client.Subscribe). Each event is encoded once for every subscriber
+	#with the same format and codec, not once per subscriber, and sent
+	#without waiting; Publish(event, acks=True) also returns Acks to wait on.
+	#With a multicast group (host, port), subscribers that join it get one
+	#datagram between them, sent to the group.
+	def __init__(self, srv, name, group=None):
+		self.srv=srv
+		self.name=name
+		self.group=group
+		self.subscribers={} #addr -> True if the peer takes events from group
+		self.seq=itertools.count(1) #Numbers events, so duplicates show
+		self.dropped=0 #Events a subscriber missed because its Outbox was full
+	def Publish(self, event, acks=False):
+		return self.srv.Publish(self, event, acks)
+
+class Audience(object):
+	#Stands in for the peer an event is encoded for, once, on behalf of the
+	#subscribers in addrs: each of them holds the objects it refers to, and
+	#no strs are interned, since each peer has its own.
+	strings=None
+	def __init__(self, srv, addrs):
+		self.srv=srv
+		self.addrs=addrs
+	def Hold(self, oid):
+		for addr in self.addrs:
+			self.srv.Hold(oid, addr)
+
+class Acks(object):
+	#The answers to an event published with acks, from each subscriber it
+	#went to. It stands in Service.outstanding, under the event's xid, until
+	#they've all answered or Wait gives up. Events aren't resent; a subscriber
+	#that doesn't answer may not have got it.
+	def __init__(self, srv, xid, addrs):
+		self.srv=srv
+		self.xid=xid
+		self.cli=None #As a DeferredResult's; there's no one peer
+		self.waiting=set(addrs)
+		self.acked=[]
+		self.errors={} #addr -> exception a subscriber's handler raised
+		self.lock=threading.Lock()
+		self.event=threading.Event()
+		if not self.waiting:
+			self.event.set()
+	def Ack(self, addr, pkt):
+		with self.lock:
+			if addr not in self.waiting:
+				return
+			self.waiting.discard(addr)
+			if pkt.Has('error'):
+				self.errors[addr]=pkt.error
+			else:
+				self.acked.append(addr)
+			done=not self.waiting
+		if done:
+			self.srv.outstanding.pop(self.xid, None)
+			self.event.set()
+	def Done(self):
+		return self.event.is_set()
+	def Wait(self, timeout=None):
+		#Returns the addrs of the subscribers that haven't answered, if any,
+		#once they all have or after timeout seconds; answers after that are
+		#ignored.
+		self.event.wait(timeout)
+		with self.lock:
+			missing=list(self.waiting)
+		if missing:
+			self.srv.outstanding.pop(self.xid, None)
+		return missing
+
+class Outbox(threading.Thread):
+	#Sends a peer its events from a queue of its own, so that a peer slow to
+	#take them--on a RELIABLE transport, whose Send waits for it--holds up
+	#neither the publisher nor the other subscribers. Put() returns False
+	#when the queue is full; that event is dropped for this peer.
+	def __init__(self, srv, cli, depth):
+		threading.Thread.__init__(self)
+		self.daemon=True
+		self.srv=srv
+		self.cli=cli
+		self.queue=Queue.Queue(depth)
+	def Put(self, datagrams):
+		try:
+			self.queue.put_nowait(datagrams)
+		except Queue.Full:
+			return False
+		return True
+	def Stop(self):
+		try:
+			self.queue.put_nowait(None)
+		except Queue.Full:
+			self.queue.get_nowait() #It's losing events anyway
+			self.queue.put_nowait(None)
+	def run(self):
+		while True:
+			datagrams=self.queue.get()
+			if datagrams is None:
+				return
+			try:
+				self.srv.Send(datagrams, self.cli)
+			except (socket.error, EOFError):
+				pass #The transport sees to it (see Service.Lost)
+
+class GroupTransport(DatagramTransport):
+	#A socket joined to a multicast group, receiving the events of the topics
+	#that publishers (by port) send to it. Datagrams from anywhere else are
+	#dropped.
+	def __init__(self, srv, group):
+		sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(('', group[1]))
+		iface=(srv.addr[0] if srv.addr[0] not in ('', '0.0.0.0') else '0.0.0.0')
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group[0])+socket.inet_aton(iface))
+		sock.settimeout(srv.RELEASE_INTERVAL)
+		DatagramTransport.__init__(self, srv, sock)
+		self.publishers={} #port -> the publisher's address, as this Service knows it
+	def Receive(self):
+		return [(data, self.publishers[src[1]]) for data, src in DatagramTransport.Receive(self) if src[1] in self.publishers]
+	def Close(self):
+		self.sock.close()
+
 class Authorizor(object):
 	def CanClientSync(self, client):
 		return True
@@ -222,45 +1227,194 @@ class Authorizor(object):
 		
 class Service(threading.Thread):
 	BUFSIZE=65536
-	XID=0
-	@classmethod
-	def NewXID(cls):
-		cls.XID=(cls.XID+1)&0xffffffff
-		return cls.XID-1
-	def __init__(self, addr=('', 12074), auth=None):
+	RELEASE_INTERVAL=1.0 #Most seconds an idle Service sits on releases
+	WORKERS=32 #Most pulls that may run at once
+	DEPTH=1024 #Most pulls that may wait for a worker before ServiceBusy
+	ORDERED=False #If True, pulls from any one client run in arrival order
+	RETRIES=8 #Resends of an unanswered request before Timeout
+	RTO_INITIAL=1.0 #Seconds before the first resend to an unmeasured peer
+	RTO_MIN=0.05
+	RTO_MAX=4.0
+	PEER_BACKOFF=2 #Most doublings timeouts add to the rest of a peer's requests
+	REPLIES=4096 #Most replies kept for answering resent requests
+	REPLY_BYTES=1<<24 #...and the most bytes they may take
+	PROMISES=4096 #Most results of pipelined pulls kept (see Promise)...
+	PROMISE_BYTES=1<<24 #...and most bytes of them, as their replies measure them
+	FRAGMENT=32768 #Largest packet sent in one datagram; bigger ones are split
+	MISSING=512 #Most fragments asked for again at a time
+	FRAGMENT_MIN=512 #Smallest FRAGMENT a peer may split packets by (see Reassemble)
+	PACE=1e8 #Bytes per second at which fragments are sent...
+	BURST=1<<17 #...after a burst of this many bytes
+	RCVBUF=1<<22 #Socket receive buffer asked for (the OS may give less)
+	REASSEMBLY_BYTES=1<<26 #Most bytes of fragments kept for reassembly
+	REASSEMBLY_TIMEOUT=10.0 #Seconds a partial packet waits for more fragments
+	TCP=False #If True, also accept StreamTransport connections on the same port
+	COMPRESS=None #Packets of this many bytes or more are compressed; None never
+	COMPRESS_LEVEL=6 #zlib level, from 1 (fastest) to 9 (smallest)
+	ZDICT='' #Preset dictionary; used with peers that have the same one
+	XID_MASK=0x7fffffff #xids wrap to fit FORMAT.BASE's signed 32-bit ints
+	SHARED=(CMD.DESYNC, CMD.RELEASE, CMD.PUSH) #Seen to by every shard
+	OUTBOX=256 #Most events queued for a subscriber on a RELIABLE transport
+	MULTICAST_TTL=1 #Hops multicast events may take; 1 keeps them on the LAN
+	def __init__(self, addr=('', 12074), auth=None, workers=None, depth=None, ordered=None, tcp=None, compress=None, shard=None, metrics=None):
 		threading.Thread.__init__(self)
 		self.daemon=True
-		#self.sock=LoggedSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
-		self.sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.sock.bind(addr)
+		self.metrics=metrics #metrics.Metrics, or None to measure nothing
+		if metrics is not None:
+			metrics.Attach(self)
+		self.pool=WorkerPool(workers or self.WORKERS, depth or self.DEPTH)
+		self.ordered=self.ORDERED if ordered is None else ordered
+		self.shard=shard
+		if shard is None:
+			#self.sock=LoggedSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+			self.sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.sock.bind(addr)
+		else:
+			self.sock=shard.sock
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+		self.sock.settimeout(self.RELEASE_INTERVAL)
 		self.addr=self.sock.getsockname()
+		self.udp=DatagramTransport(self)
+		self.poller=Poller()
+		self.poller.Add(self.udp)
+		if (self.TCP if tcp is None else tcp):
+			self.poller.Add(StreamListener(self, (addr[0], self.addr[1])))
 		self.auth=auth or Authorizor()
-		self.omap={} #id -> object tracked
-		self.pubmap={} #public object name -> id
-		self.outstanding={} #xid -> Deferred
+		threshold=self.COMPRESS if compress is None else compress
+		self.codec=packet.Codec(threshold, self.COMPRESS_LEVEL, self.ZDICT)
+		self.plaincodec=packet.Codec(threshold, self.COMPRESS_LEVEL) if self.ZDICT else self.codec
+		self.omap={} #oid -> object tracked
+		self.oids={} #id(object) -> oid, for objects in omap
+		self.holds={} #oid -> {addr: references sent and not yet released}
+		self.omaplock=threading.Lock()
+		#OIDs are never reused; a shard's are index+count*n.
+		self.stride, self.stripe=((shard.count, shard.index) if shard is not None else (1, 0))
+		self.nextoid=itertools.count(self.stride+self.stripe, self.stride)
+		self.pubmap={} #public object name -> oid
+		self.outstanding={} #xid -> DeferredResult, or Acks
+		#Peers keep replies by (our address, xid), so a Service restarted on
+		#the same port starts somewhere else, rather than being answered from
+		#its last run.
+		self.xids=itertools.count(random.randrange(self.XID_MASK+1))
 		self.clients={} #addr -> Client
+		self.refs={} #(addr, oid) -> RefHandle
+		self.reflock=threading.Lock()
+		self.releases=collections.deque() #RefHandles of collected references, and KeptHandles
+		self.keeping=set() #KeptHandles of Promises for results peers keep
+		self.subscribers={} #oid -> set of addrs to push changes to
+		self.timer=Retransmitter(self)
+		self.replies=collections.OrderedDict() #(addr, xid) -> (datagrams, bytes) sent
+		self.replybytes=0
+		self.running=set() #(addr, xid) of requests being worked on
+		self.replylock=threading.Lock()
+		self.kept=collections.OrderedDict() #(addr, xid) -> Kept, oldest first
+		self.topics={} #name -> Topic published here
+		self.handlers={} #(publisher addr, topic) -> funcs subscribed to it...
+		self.eventseq={} #...and the last event's seq
+		self.groups={} #multicast (host, port) -> GroupTransport joined
+		self.keptbytes=0
+		self.keptlock=threading.Lock()
+		self.pacer=Pacer(self.PACE, self.BURST)
+		self.nextmsg=itertools.count() #Numbers fragmented packets
+		self.partial=collections.OrderedDict() #(addr, msg) -> Partial, oldest first
+		self.partialbytes=0
+		self.relay=None
+		if shard is not None:
+			shard.relays[shard.index].settimeout(self.RELEASE_INTERVAL)
+			self.relay=DatagramTransport(self, shard.relays[shard.index])
+			self.poller.Add(self.relay)
+			self.shards=[] #Clients for each shard, this one included
+			for relay in shard.addrs:
+				cli=self.GetClient(relay)
+				cli.transport=self.relay
+				cli.format=serialize.FORMAT.LATEST #It's this same code
+				self.shards.append(cli)
 		serialize.SetSerializer(object, ObjectTranslator(self))
-	def Connect(self, addr):
+	def Connect(self, addr, transport=None):
+		#transport is the class of transport to reach the peer with; if not
+		#given, DatagramTransport (UDP) for a new peer, or whatever a known
+		#one already uses.
 		#print 'Connecting to', addr
-		if addr not in self.clients:
+		cli=self.clients.get(addr)
+		if cli is not None and transport is not None and not isinstance(cli.transport, transport):
+			cli.transport=transport.Open(self, addr)
+		if cli is None:
 			cli=self.GetClient(addr)
+			if transport is not None:
+				try:
+					cli.transport=transport.Open(self, addr)
+				except Exception:
+					self.clients.pop(addr, None)
+					raise
 			#print '(new client)'
-			self.SendPacket(cli, _cmd=CMD.SYNC).Wait()
-			return cli
-		return self.clients[addr]
+			act=self.SendPacket(cli, _cmd=CMD.SYNC, format=serialize.FORMAT.LATEST, zdict=self.codec.id)
+			try:
+				act.Wait()
+			except (Timeout, Disconnected):
+				self.clients.pop(addr, None)
+				raise
+			#Peers that predate formats don't answer with one.
+			if act.reply.Has('format'):
+				cli.format=act.reply.format
+				if cli.format>=serialize.FORMAT.COMPRESSED:
+					cli.codec=self.AgreeCodec(act.reply)
+		return cli
 	def Disconnect(self, addr):
 		cli=self.GetClient(addr)
-		self.SendPacket(cli, _cmd=CMD.DESYNC)
+		act=self.SendPacket(cli, _cmd=CMD.DESYNC).Go()
+		if cli.transport.RELIABLE:
+			act.AddCallback(lambda act, transport=cli.transport: self.Lost(transport))
 	def Register(self, obj, name):
-		self.omap[id(obj)]=obj
-		self.pubmap[name]=id(obj)
+		self.pubmap[name]=self.Track(obj)
 	def Unregister(self, name):
 		try:
-			del self.pubmap[name]
+			oid=self.pubmap.pop(name)
 		except KeyError:
-			pass
+			return
+		with self.omaplock:
+			self.Collect(oid)
+	def Track(self, obj):
+		#Returns obj's OID, entering it into omap if it isn't there yet.
+		with self.omaplock:
+			oid=self.oids.get(id(obj))
+			if oid is None or self.omap.get(oid) is not obj:
+				oid=self.nextoid.next()
+				self.omap[oid]=obj
+				self.oids[id(obj)]=oid
+			return oid
+	def Hold(self, oid, addr):
+		with self.omaplock:
+			holders=self.holds.setdefault(oid, {})
+			holders[addr]=holders.get(addr, 0)+1
+	def Release(self, oid, addr, count):
+		with self.omaplock:
+			holders=self.holds.get(oid)
+			if holders is None or addr not in holders:
+				return
+			holders[addr]-=count
+			if holders[addr]<=0:
+				del holders[addr]
+				self.subscribers.get(oid, set()).discard(addr)
+				if not holders:
+					del self.holds[oid]
+					self.Collect(oid)
+	def Collect(self, oid):
+		#Drops oid from omap if no peer holds it and it isn't published. The
+		#caller holds omaplock.
+		if oid in self.holds or oid in self.pubmap.values():
+			return
+		obj=self.omap.pop(oid, None)
+		if self.oids.get(id(obj))==oid:
+			del self.oids[id(obj)]
+		self.subscribers.pop(oid, None)
 	def Resolve(self, cli, name):
-		return self.SendPacket(cli, _cmd=CMD.RESOLVE, name=name).Wait()
+		#Peers that know CallMethod list the object's methods (see Methods).
+		act=self.SendPacket(cli, _cmd=CMD.RESOLVE, name=name, describe=True)
+		prx=act.Wait()
+		methods=act.reply.attrs.get('methods')
+		if methods is not None and isinstance(prx, proxy.Proxy) and isinstance(prx._obj, RemoteReference):
+			prx._obj.methods=frozenset(methods)
+		return prx
 	def List(self, cli):
 		return self.SendPacket(cli, _cmd=CMD.LIST).Wait()
 	def GetClient(self, addr):
@@ -270,16 +1424,275 @@ class Service(threading.Thread):
 			cli=Client(addr, self)
 			self.clients[addr]=cli
 			return cli
+	def GetReference(self, cli, oid, count=1):
+		#One RemoteReference per remote object, so that pushes reach its cache,
+		#and so that one RELEASE covers every time the peer sent it.
+		key=(cli.addr, oid)
+		with self.reflock:
+			handle=self.refs.get(key)
+			ref=(handle() if handle is not None else None)
+			if ref is None:
+				ref=RemoteReference(self, cli, oid)
+				handle=RefHandle(ref, self.releases.append)
+				handle.key=key
+				handle.count=0
+				self.refs[key]=handle
+			handle.count+=count
+		return ref
+	def Count(self, refs):
+		#Counts references read from a packet that was not a duplicate.
+		with self.reflock:
+			for ref in refs:
+				handle=self.refs.get((ref.cli.addr, ref.oid))
+				if handle is not None and handle() is ref:
+					handle.count+=1
+	def FlushReleases(self):
+		#Tells peers about references collected since the last flush. This
+		#can't happen in the weakref callback, which may run in the middle of
+		#anything, so collected handles wait in self.releases until now.
+		byaddr={} #addr -> (oids and counts, kept xids)
+		while True:
+			try:
+				handle=self.releases.popleft()
+			except IndexError: #Another thread flushed the rest
+				break
+			if isinstance(handle, KeptHandle):
+				self.keeping.discard(handle)
+				addr, xid=handle.key
+				byaddr.setdefault(addr, ([], []))[1].append(xid)
+				continue
+			with self.reflock:
+				if self.refs.get(handle.key) is handle:
+					del self.refs[handle.key]
+			addr, oid=handle.key
+			if handle.count:
+				byaddr.setdefault(addr, ([], []))[0].append((oid, handle.count))
+		for addr, (oids, xids) in byaddr.iteritems():
+			cli=self.clients.get(addr)
+			#Peers that predate formats don't know RELEASE (and never free).
+			if cli is None or cli.format<serialize.FORMAT.COMPACT:
+				continue
+			if xids:
+				self.SendPacket(cli, _cmd=CMD.RELEASE, oids=oids, kept=xids).Go()
+			else:
+				self.SendPacket(cli, _cmd=CMD.RELEASE, oids=oids).Go()
+	def Keeping(self, promise):
+		#Sees that the peer is told to drop the result of promise's pull once
+		#promise is collected; returns promise.
+		handle=KeptHandle(promise, self.releases.append)
+		handle.key=(promise.cli.addr, promise.act.xid)
+		self.keeping.add(handle)
+		return promise
+	def Notify(self, oid, cli, **kwargs):
+		#Pushes a change to oid, made on behalf of cli, to its other subscribers.
+		for addr in list(self.subscribers.get(oid, ())):
+			if addr!=cli.addr and addr in self.clients:
+				self.SendPacket(self.clients[addr], _cmd=CMD.PUSH, oid=oid, **kwargs).Go()
+	def NewXID(self):
+		#count.next is atomic under the GIL, so no two threads get the same
+		#number until it wraps; then any still outstanding are passed over.
+		#Replies are matched by xid alone, not by the address they came from
+		#(a peer bound to every interface answers from a particular one), so
+		#one count serves every peer. A shard's xids are index+count*n, like
+		#its OIDs, so that replies can find their way back to it.
+		while True:
+			xid=(self.xids.next()%((self.XID_MASK+1)//self.stride))*self.stride+self.stripe
+			if xid not in self.outstanding:
+				return xid
 	def SendPacket(self, cli, **kwargs):
+		if self.releases:
+			self.FlushReleases()
 		xid=self.NewXID()
 		if '_cmd' in kwargs:
 			cmd=kwargs['_cmd']
 			del kwargs['_cmd']
 		else:
 			cmd=CMD.PULL
-		act=DeferredResult(self, xid, lambda self=self, xid=xid, cmd=cmd, kwargs=kwargs, cli=cli: self.sock.sendto(str(packet.Packet(cmd, xid=xid, **kwargs)), cli.addr))
+		act=DeferredResult(self, xid, None, cli, packet.Packet(cmd, xid=xid, **kwargs))
 		self.outstanding[xid]=act
 		return act
+	def AgreeCodec(self, pkt):
+		#Both ends use the preset dictionary only if they have the same one.
+		if pkt.attrs.get('zdict')==self.codec.id:
+			return self.codec
+		return self.plaincodec
+	def SendTo(self, pkt, cli):
+		self.Send(self.Frame(self.Encode(pkt, cli), cli), cli)
+	def Encode(self, pkt, cli, defined=None, codec=None, peer=None):
+		#Encodes pkt in cli's format, for cli or else peer (see Audience).
+		if self.metrics is None:
+			return pkt.ToStr(cli.format, peer or cli, defined, codec)
+		start=time.time()
+		data=pkt.ToStr(cli.format, peer or cli, defined, codec)
+		self.metrics.Encoded(time.time()-start, len(data))
+		return data
+	def Frame(self, data, cli, reply=None, transport=None):
+		#Returns the datagrams that carry the encoded packet data to cli:
+		#just data, unless it's longer than FRAGMENT, in which case it's split
+		#into FRAGMENT packets. Those carrying a reply name its xid, so that
+		#the waiting side knows it's coming. Peers that predate formats get
+		#data whole, as before, and can't receive more than BUFSIZE; so do
+		#peers on a RELIABLE transport, which has no such limit. transport, if
+		#given, is the one data goes by instead of cli's.
+		if len(data)<=self.FRAGMENT or cli.format<serialize.FORMAT.COMPACT or (transport or cli.transport).RELIABLE:
+			return [data]
+		msg=self.nextmsg.next()
+		count=(len(data)+self.FRAGMENT-1)//self.FRAGMENT
+		frags=[]
+		for index in xrange(count):
+			pkt=packet.Packet(CMD.FRAGMENT, msg=msg, index=index, count=count, data=data[index*self.FRAGMENT:(index+1)*self.FRAGMENT])
+			if reply is not None:
+				pkt.reply=reply
+			frags.append(pkt.ToStr(cli.format, cli))
+		return frags
+	def Send(self, datagrams, cli):
+		if self.metrics is not None:
+			self.metrics.Sent(cli.addr, sum(len(data) for data in datagrams), len(datagrams))
+		cli.transport.Send(datagrams, cli.addr)
+	def Lost(self, transport):
+		#A connection closed; transactions waiting on it will never hear back.
+		#The peer is still there on UDP, which every Service listens on.
+		self.poller.Remove(transport)
+		transport.Close()
+		cli=self.clients.get(transport.addr)
+		if cli is None or cli.transport is not transport:
+			return
+		cli.transport=self.udp
+		for xid, act in self.outstanding.items():
+			if act.cli is cli and self.outstanding.pop(xid, None) is act:
+				act.Accept(packet.Packet(act.pkt.cmd, xid=xid, error=Disconnected('Connection to %r lost'%(cli.addr,))))
+	def Reassemble(self, pkt, cli):
+		#Files away a FRAGMENT, returning the whole packet's data once every
+		#fragment of it is in, or None until then. Partial packets are dropped
+		#once they're REASSEMBLY_TIMEOUT seconds stale, or, oldest first, to
+		#keep the lot under REASSEMBLY_BYTES; so are those said to have more
+		#fragments than could fit, or whose fields aren't what Fragment sends.
+		attrs=pkt.attrs
+		if not all(isinstance(attrs.get(field), (int, long)) for field in ('msg', 'count', 'index')) or not isinstance(attrs.get('data'), str):
+			return None
+		if not 0<pkt.count<=self.REASSEMBLY_BYTES//self.FRAGMENT_MIN:
+			return None #Couldn't be put back together anyway; a bad header
+		now=time.time()
+		key=(cli.addr, pkt.msg)
+		part=self.partial.pop(key, None)
+		if part is not None and part.count!=pkt.count:
+			self.partialbytes-=part.size
+			part=None
+		if part is None:
+			part=Partial(pkt.count)
+		if pkt.index not in part.parts and 0<=pkt.index<part.count:
+			part.parts[pkt.index]=pkt.data
+			part.size+=len(pkt.data)
+			self.partialbytes+=len(pkt.data)
+		part.stamp=now
+		if len(part.parts)==part.count:
+			self.partialbytes-=part.size
+			return ''.join(part.parts[index] for index in xrange(part.count))
+		self.partial[key]=part
+		self.ExpirePartials(now)
+		return None
+	def ExpirePartials(self, now):
+		while self.partial:
+			key, part=next(self.partial.iteritems())
+			if now-part.stamp<self.REASSEMBLY_TIMEOUT and self.partialbytes<=self.REASSEMBLY_BYTES:
+				break
+			del self.partial[key]
+			self.partialbytes-=part.size
+	def Transmit(self, act):
+		#Sends (or resends) a request, and arranges to resend it if need be.
+		#Resends repeat the first encoding, so objects in it are held once.
+		cli=act.cli
+		if act.data is None:
+			act.data=self.Frame(self.Encode(act.pkt, cli, act.defined, cli.codec), cli)
+		act.sends+=1
+		act.sentat=time.time()
+		if act.firstat is None:
+			act.firstat=act.sentat
+		self.Send(act.data, cli)
+		#Peers that predate formats would run a resent request again. SYNC is
+		#safe to repeat, and is how we find out. RELIABLE transports don't
+		#need the help.
+		if cli.transport.RELIABLE:
+			return
+		if cli.format>=serialize.FORMAT.COMPACT or act.pkt.cmd==CMD.SYNC:
+			self.Arm(act)
+	def Arm(self, act):
+		#A request backs off by its own timeouts or its peer's, whichever
+		#is more; they don't compound.
+		cli=act.cli
+		self.timer.Watch(act, min((cli.rto or self.RTO_INITIAL)*2**max(act.backoff, cli.backoff), self.RTO_MAX))
+	def Expired(self, act):
+		#Called by the Retransmitter when act's timeout passes with no reply.
+		if act.retries>=self.RETRIES:
+			if self.outstanding.pop(act.xid, None) is act:
+				act.Accept(packet.Packet(act.pkt.cmd, xid=act.xid, error=Timeout('No reply to transaction %d from %r after %d tries'%(act.xid, act.cli.addr, act.sends))))
+			return
+		cli=act.cli
+		if not act.backoff and not act.pending and act.sentat>=cli.backedoff:
+			#A timeout backs off the whole peer too, as TCP does, until a
+			#fresh round trip is measured; otherwise requests sent after a
+			#burst that overran the peer are resent as early, and so on. Only
+			#requests sent since the last backoff count, so that a burst backs
+			#off once, not once per request in it; and only by PEER_BACKOFF
+			#doublings, so that one unlucky loss doesn't slow every call.
+			cli.backoff=min(cli.backoff+1, self.PEER_BACKOFF)
+			cli.backedoff=time.time()
+		act.retries+=1
+		act.backoff+=1
+		part=self.partial.get((act.cli.addr, act.replymsg))
+		if act.progress and part is not None:
+			#Part of the reply came; ask for the rest, rather than for all of
+			#it again. If nothing comes of that, the request goes next time.
+			act.progress=False
+			missing=list(itertools.islice((index for index in xrange(part.count) if index not in part.parts), self.MISSING))
+			self.SendTo(packet.Packet(CMD.FRAGMENT, xid=act.xid, missing=missing), act.cli)
+			self.Arm(act)
+		else:
+			self.Transmit(act)
+	def Sample(self, cli, rtt):
+		if cli.srtt is None:
+			cli.srtt=rtt
+			cli.rttvar=rtt/2
+		else:
+			cli.rttvar=0.75*cli.rttvar+0.25*abs(cli.srtt-rtt)
+			cli.srtt=0.875*cli.srtt+0.125*rtt
+		cli.rto=min(max(cli.srtt+4*cli.rttvar, self.RTO_MIN), self.RTO_MAX)
+		cli.backoff=0
+	def Fresh(self, pkt, cli):
+		#Returns True if pkt is a request to be handled, or False if it was
+		#seen before, in which case the peer is answered again here.
+		key=(cli.addr, pkt.xid)
+		with self.replylock:
+			if pkt.cmd==CMD.SYNC:
+				#A new session; its xids may collide with an old one's.
+				for old in [k for k in self.replies if k[0]==cli.addr]:
+					self.replybytes-=self.replies.pop(old)[1]
+			data, size=self.replies.get(key, (None, 0))
+			if data is None:
+				if key not in self.running:
+					self.running.add(key)
+					return True
+		if data is not None:
+			self.Send(data, cli)
+		elif cli.format>=serialize.FORMAT.COMPACT:
+			self.SendTo(packet.Packet(pkt.cmd, xid=pkt.xid, pending=True), cli)
+		return False
+	def Reply(self, pkt, cli):
+		#Answers a request, keeping the answer in case the request is resent.
+		data=self.Frame(self.Encode(pkt, cli, codec=cli.codec), cli, pkt.xid)
+		size=sum(len(d) for d in data)
+		key=(cli.addr, pkt.xid)
+		with self.replylock:
+			self.running.discard(key)
+			old=self.replies.pop(key, None)
+			if old is not None:
+				self.replybytes-=old[1]
+			self.replies[key]=(data, size)
+			self.replybytes+=size
+			while len(self.replies)>self.REPLIES or self.replybytes>self.REPLY_BYTES:
+				self.replybytes-=self.replies.popitem(False)[1][1]
+		self.Send(data, cli)
+		return size
 	def GetAttr(self, cli, oid, attr):
 		return self.SendPacket(cli, op='GetAttr', oid=oid, attr=attr)
 	def SetAttr(self, cli, oid, attr, val):
@@ -300,66 +1713,546 @@ class Service(threading.Thread):
 		return self.SendPacket(cli, op='Str', oid=oid)
 	def Call(self, cli, oid, *args, **kwargs):
 		return self.SendPacket(cli, op='Call', oid=oid, args=args, kwargs=kwargs)
+	def CallMethod(self, cli, oid, name, *args, **kwargs):
+		return self.SendPacket(cli, op='CallMethod', oid=oid, attr=name, args=args, kwargs=kwargs)
+	def Iter(self, cli, oid, count):
+		return self.SendPacket(cli, op='Iter', oid=oid, count=count)
+	def Next(self, cli, oid, count):
+		return self.SendPacket(cli, op='Next', oid=oid, count=count)
 	def run(self):
+		self.timer.start()
 		while True:
-			data, src=self.sock.recvfrom(self.BUFSIZE)
-			cli=self.GetClient(src)
-			try:
-				pkt=packet.Packet.FromStr(data)
-			except Exception:
-				print 'Exception encountered parsing packet:'
-				traceback.print_exc()
-				print 'Continuing...'
+			ready, writable=self.poller.Poll(self.RELEASE_INTERVAL)
+			if not ready and not writable:
+				self.FlushReleases()
+				self.ExpirePartials(time.time())
 				continue
-			if pkt.Has('result') or pkt.Has('error'):
-				Deferred.SendAll(pkt)
+			for transport in writable:
+				transport.Flush()
+			for transport in ready:
+				try:
+					received=transport.Receive()
+				except (socket.error, EOFError):
+					if not transport.RELIABLE:
+						raise
+					self.Lost(transport)
+					continue
+				if self.metrics is not None:
+					for data, src in received:
+						self.metrics.Received(src, len(data))
+				for data, src in received:
+					#A packet that parses can still carry fields of the wrong
+					#type or missing ones; that peer's packet is dropped, but
+					#the Service goes on.
+					try:
+						self.Handle(data, self.GetClient(src))
+					except Exception:
+						print 'Exception encountered handling packet:'
+						traceback.print_exc()
+						print 'Continuing...'
+	def Handle(self, data, cli, relayed=False, quiet=False):
+		#relayed packets were passed on by the shard that received them (see
+		#Shard), which has already answered the quiet ones.
+		sharded=(self.shard is not None and not relayed and cli.transport is not self.relay)
+		if ord(data[0])&packet.CMD_MASK==CMD.FRAGMENT:
+			data=self.Fragment(data, cli, sharded)
+			if data is None:
+				return
+		cli.received=[]
+		if sharded:
+			cli.used=[]
+		try:
+			if self.metrics is None:
+				pkt=packet.Packet.FromStr(data, cli)
 			else:
-				getattr(self, 'cmd_'+CMD.NAMES[pkt.cmd], self.cmd_Unknown)(pkt, cli)
+				start=time.time()
+				pkt=packet.Packet.FromStr(data, cli)
+				self.metrics.Decoded(time.time()-start, len(data))
+		except Exception:
+			print 'Exception encountered parsing packet:'
+			traceback.print_exc()
+			print 'Continuing...'
+			return
+		finally:
+			received, cli.received=cli.received, None
+			used, cli.used=cli.used, None
+		if pkt.cmd==CMD.RELAY:
+			if cli.transport is self.relay and self.relay is not None:
+				self.cmd_RELAY(pkt, cli)
+			return
+		if sharded:
+			owner=self.Owner(pkt)
+			if owner!=self.shard.index:
+				self.Relay(owner, data, cli, used)
+				return
+		if pkt.cmd==CMD.EVENT and (pkt.Has('result') or pkt.Has('error')):
+			acks=self.outstanding.get(pkt.xid)
+			if isinstance(acks, Acks):
+				acks.Ack(cli.addr, pkt)
+		elif pkt.Has('result') or pkt.Has('error'):
+			act=self.outstanding.pop(pkt.xid, None)
+			if act is not None:
+				if act.sends==1 and not act.pending:
+					self.Sample(act.cli, time.time()-act.sentat)
+				if act.defined:
+					act.cli.strings.Confirm(act.defined)
+				if self.metrics is not None and act.firstat is not None:
+					self.metrics.Answered(act.cli.addr, act.pkt.attrs.get('op') or CMD.NAMES.get(act.pkt.cmd),
+						time.time()-act.firstat, not pkt.Has('error'))
+				self.Count(received)
+				act.Accept(pkt)
+		elif pkt.Has('pending'):
+			act=self.outstanding.get(pkt.xid)
+			if act is not None:
+				act.pending=True
+				act.retries=0
+		elif quiet:
+			self.Mirror(pkt, cli)
+		elif pkt.cmd==CMD.EVENT:
+			if self.FreshEvent(pkt, cli):
+				self.Count(received)
+				self.cmd_EVENT(pkt, cli)
+		elif self.Fresh(pkt, cli):
+			self.Count(received)
+			if self.metrics is not None:
+				self.metrics.Handled(cli.addr, (pkt.attrs.get('op') if pkt.cmd==CMD.PULL else None) or CMD.NAMES.get(pkt.cmd, 'Unknown'))
+			if sharded and pkt.cmd in self.SHARED:
+				for index in xrange(self.shard.count):
+					if index!=self.shard.index:
+						self.Relay(index, data, cli, used, True)
+			getattr(self, 'cmd_'+CMD.NAMES.get(pkt.cmd, 'Unknown'), self.cmd_Unknown)(pkt, cli)
+	def Owner(self, pkt):
+		#The shard a packet from a peer is for: the one that sent the request
+		#it answers, or that owns the object it acts on; or else this one.
+		n=None
+		if pkt.Has('result') or pkt.Has('error') or pkt.Has('pending'):
+			n=pkt.attrs.get('xid')
+		elif pkt.cmd==CMD.PULL:
+			n=pkt.attrs.get('oid')
+		elif pkt.cmd==CMD.BATCH:
+			try:
+				n=pkt.ops[0]['oid'] #Batches are best kept to one shard's objects
+			except (LookupError, TypeError):
+				pass
+		if not isinstance(n, (int, long)):
+			return self.shard.index
+		return n%self.shard.count
+	def Relay(self, index, data, cli, used, quiet=False):
+		#Passes a packet from cli's peer on to shard index, with what it takes
+		#to read and answer it: the peer's format, and the strs it had
+		#interned with this shard that the packet uses.
+		pkt=packet.Packet(CMD.RELAY, addr=list(cli.addr), data=str(data), format=cli.format,
+			zdict=(cli.codec.id if cli.codec is not None else 0), syncs=cli.syncs)
+		if used:
+			pkt.strings=used
+		if quiet:
+			pkt.quiet=True
+		self.SendTo(pkt, self.shards[index])
+	def ShareName(self, cli, index, string):
+		#Tells the other shards that this one has defined string as index to
+		#cli's peer, which may echo it to any of them.
+		if cli.transport is self.relay:
+			return
+		for other, shard in enumerate(self.shards):
+			if other!=self.shard.index:
+				self.SendTo(packet.Packet(CMD.RELAY, addr=list(cli.addr), names=[(index, string)]), shard)
+	def cmd_RELAY(self, pkt, cli):
+		#A packet received by another shard, from its peer at addr, or word of
+		#what that shard has defined strs as to the peer.
+		peer=self.GetClient(tuple(pkt.addr))
+		for index, string in pkt.attrs.get('names', ()):
+			peer.strings.names[index]=string
+		if not pkt.Has('data'):
+			return
+		if peer.syncs!=pkt.syncs:
+			peer.strings.Forget()
+			peer.syncs=pkt.syncs
+		peer.format=pkt.format
+		peer.codec=(self.AgreeCodec(pkt) if pkt.format>=serialize.FORMAT.COMPRESSED else None)
+		try:
+			for index, string in pkt.attrs.get('strings', ()):
+				peer.strings.Receive(index, string)
+		except ValueError:
+			print 'Exception encountered parsing packet:'
+			traceback.print_exc()
+			print 'Continuing...'
+			return
+		self.Handle(pkt.data, peer, True, pkt.attrs.get('quiet', False))
+	def Mirror(self, pkt, cli):
+		#Does what another shard was asked of every shard (see SHARED), but
+		#for answering, which that shard has seen to.
+		if pkt.cmd==CMD.DESYNC:
+			self.Desync(cli)
+		elif pkt.cmd==CMD.RELEASE:
+			for oid, count in pkt.oids:
+				self.Release(oid, cli.addr, count)
+		elif pkt.cmd==CMD.PUSH:
+			self.Pushed(pkt, cli)
+	def Fragment(self, data, cli, sharded=False):
+		raw=data
+		try:
+			pkt=packet.Packet.FromStr(data, cli)
+		except Exception:
+			print 'Exception encountered parsing fragment:'
+			traceback.print_exc()
+			return None
+		if pkt.Has('missing'):
+			#The peer lost some fragments of our reply to its request xid. On
+			#a shard, any of them may have sent it.
+			with self.replylock:
+				data, size=self.replies.get((cli.addr, pkt.xid), (None, 0))
+			if data is not None:
+				self.Send([data[index] for index in pkt.missing if 0<=index<len(data)], cli)
+			elif sharded:
+				for index in xrange(self.shard.count):
+					if index!=self.shard.index:
+						self.Relay(index, raw, cli, None)
+			return None
+		if pkt.Has('reply'):
+			#More of a reply is arriving; hold off on resending its request.
+			act=self.outstanding.get(pkt.reply)
+			if act is not None:
+				act.pending=True
+				act.progress=True
+				act.replymsg=pkt.msg
+				act.retries=0
+				self.Arm(act)
+		return self.Reassemble(pkt, cli)
 	def cmd_SYNC(self, pkt, cli):
+		#The answer goes out in the base format; the peer may not know others.
+		cli.format=serialize.FORMAT.BASE
+		cli.codec=None
+		cli.strings.Forget()
+		cli.syncs+=1
+		self.Unkeep(cli.addr)
 		if self.auth.CanClientSync(cli):
-			self.sock.sendto(str(packet.Packet(CMD.SYNC, xid=pkt.xid, result=True)), cli.addr)
+			fmt=min(pkt.format, serialize.FORMAT.LATEST) if pkt.Has('format') else serialize.FORMAT.BASE
+			codec=self.AgreeCodec(pkt)
+			self.Reply(packet.Packet(CMD.SYNC, xid=pkt.xid, result=True, format=fmt, zdict=codec.id), cli)
+			cli.format=fmt
+			if fmt>=serialize.FORMAT.COMPRESSED:
+				cli.codec=codec
 		else:
-			self.sock.sendto(str(packet.Packet(CMD.SYNC, xid=pkt.xid, result=False)), cli.addr)
+			self.Reply(packet.Packet(CMD.SYNC, xid=pkt.xid, result=False), cli)
 			del self.clients[cli.addr]
+	def Topic(self, name, group=None):
+		#The Topic called name, made (to multicast to group, if given) if
+		#there isn't one yet.
+		topic=self.topics.get(name)
+		if topic is None:
+			if group is not None:
+				self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.MULTICAST_TTL)
+				if self.addr[0] not in ('', '0.0.0.0'):
+					self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.addr[0]))
+				group=tuple(group)
+			topic=self.topics[name]=Topic(self, name, group)
+		return topic
+	def Publish(self, topic, event, acks=False):
+		#Sends event to topic's subscribers (topic may be a Topic or its name),
+		#and returns Acks if asked to, or else None.
+		if not isinstance(topic, Topic):
+			topic=self.topics[topic]
+		pkt=packet.Packet(CMD.EVENT, topic=topic.name, seq=topic.seq.next(), data=event)
+		groups=collections.defaultdict(list) #How it's encoded -> subscribers
+		for addr, grouped in topic.subscribers.items():
+			cli=self.clients.get(addr)
+			if cli is None:
+				continue
+			if grouped:
+				groups[None].append(cli)
+			else:
+				groups[cli.format, cli.codec, cli.transport.RELIABLE].append(cli)
+		res=None
+		if acks:
+			pkt.xid=self.NewXID()
+			res=self.outstanding[pkt.xid]=Acks(self, pkt.xid, [sub.addr for subs in groups.itervalues() for sub in subs])
+		for key, clis in groups.iteritems():
+			if key is None:
+				#Every member can read the format the oldest of them reads.
+				cli=min(clis, key=lambda cli: cli.format)
+				datagrams=self.Frame(self.Encode(pkt, cli, peer=Audience(self, [sub.addr for sub in clis])), cli, transport=self.udp)
+				if self.metrics is not None:
+					self.metrics.Sent(topic.group, sum(len(data) for data in datagrams), len(datagrams))
+				self.udp.Send(datagrams, topic.group)
+				continue
+			datagrams=self.Frame(self.Encode(pkt, clis[0], codec=clis[0].codec, peer=Audience(self, [sub.addr for sub in clis])), clis[0])
+			for cli in clis:
+				if cli.transport.RELIABLE:
+					if cli.outbox is None:
+						cli.outbox=Outbox(self, cli, self.OUTBOX)
+						cli.outbox.start()
+					if not cli.outbox.Put(datagrams):
+						topic.dropped+=1
+				else:
+					try:
+						self.Send(datagrams, cli) #UDP doesn't wait for the peer
+					except socket.error:
+						topic.dropped+=1
+		return res
+	def Subscribe(self, cli, topic, func, multicast=False):
+		#Has func(event) called with each event the peer publishes to topic,
+		#in order, from a worker; it may block, but holds up that topic's
+		#later events. With multicast, events come through the topic's group,
+		#if it has one.
+		key=(cli.addr, topic)
+		funcs=self.handlers.get(key)
+		if funcs:
+			funcs.append(func)
+			return
+		self.handlers[key]=[func]
+		self.eventseq[key]=0 #The publisher may have started over
+		try:
+			act=self.SendPacket(cli, _cmd=CMD.SUBSCRIBE, topic=topic)
+			act.Wait()
+			group=act.reply.attrs.get('group')
+			if multicast and group is not None:
+				self.Join(tuple(group), cli)
+				self.SendPacket(cli, _cmd=CMD.SUBSCRIBE, topic=topic, multicast=True).Wait()
+		except Exception:
+			self.handlers.pop(key, None)
+			raise
+	def Unsubscribe(self, cli, topic, func):
+		key=(cli.addr, topic)
+		funcs=self.handlers.get(key, [])
+		if func in funcs:
+			funcs.remove(func)
+		if not funcs and self.handlers.pop(key, None) is not None:
+			self.SendPacket(cli, _cmd=CMD.SUBSCRIBE, topic=topic, off=True).Go()
+	def Join(self, group, cli):
+		#Listens to group for events from the peer cli.
+		transport=self.groups.get(group)
+		if transport is None:
+			transport=self.groups[group]=GroupTransport(self, group)
+			self.poller.Add(transport)
+		transport.publishers[cli.addr[1]]=cli.addr
+	def cmd_SUBSCRIBE(self, pkt, cli):
+		topic=self.topics.get(pkt.topic)
+		if topic is None:
+			pkt.error=NameError('No such topic')
+		elif pkt.attrs.get('off'):
+			topic.subscribers.pop(cli.addr, None)
+			pkt.result=True
+		else:
+			topic.subscribers[cli.addr]=bool(pkt.attrs.get('multicast') and topic.group)
+			pkt.result=True
+			if topic.group is not None:
+				pkt.group=list(topic.group)
+		self.Reply(pkt, cli)
+	def FreshEvent(self, pkt, cli):
+		#Events aren't resent, so they skip Fresh; duplicates are told by
+		#their seq, and old ones dropped with them.
+		key=(cli.addr, pkt.topic)
+		if pkt.seq<=self.eventseq.get(key, 0):
+			return False
+		self.eventseq[key]=pkt.seq
+		return True
+	def cmd_EVENT(self, pkt, cli):
+		key=(cli.addr, pkt.topic)
+		funcs=self.handlers.get(key)
+		if funcs is None:
+			if pkt.Has('xid'):
+				self.SendTo(packet.Packet(CMD.EVENT, xid=pkt.xid, error=NameError('Not subscribed')), cli)
+			return
+		if not self.pool.Submit(self.Deliver, (pkt, cli, list(funcs)), key) and pkt.Has('xid'):
+			self.SendTo(packet.Packet(CMD.EVENT, xid=pkt.xid, error=ServiceBusy('Too many events waiting')), cli)
+	def Deliver(self, pkt, cli, funcs):
+		error=None
+		for func in funcs:
+			try:
+				func(pkt.data)
+			except Exception, e:
+				print 'Exception encountered in event handler:'
+				traceback.print_exc()
+				error=e
+		if pkt.Has('xid'):
+			if error is None:
+				self.SendTo(packet.Packet(CMD.EVENT, xid=pkt.xid, result=True), cli)
+			else:
+				self.SendTo(packet.Packet(CMD.EVENT, xid=pkt.xid, error=error), cli)
 	def cmd_DESYNC(self, pkt, cli):
-		del self.clients[cli.addr]
+		self.Desync(cli)
+		self.Reply(packet.Packet(CMD.DESYNC, xid=pkt.xid, result=True), cli)
+	def Desync(self, cli):
+		self.clients.pop(cli.addr, None)
+		self.Unkeep(cli.addr)
+		for topic in self.topics.values():
+			topic.subscribers.pop(cli.addr, None)
+		if cli.outbox is not None:
+			cli.outbox.Stop()
+			cli.outbox=None
+		for subs in self.subscribers.values():
+			subs.discard(cli.addr)
+		for oid, holders in self.holds.items():
+			if cli.addr in holders:
+				self.Release(oid, cli.addr, holders[cli.addr])
+	def cmd_RELEASE(self, pkt, cli):
+		for oid, count in pkt.oids:
+			self.Release(oid, cli.addr, count)
+		for xid in pkt.attrs.get('kept', ()):
+			self.Unkeep(cli.addr, xid)
+		self.Reply(packet.Packet(CMD.RELEASE, xid=pkt.xid, result=True), cli)
+	def cmd_PUSH(self, pkt, cli):
+		self.Pushed(pkt, cli)
+		self.Reply(packet.Packet(CMD.PUSH, xid=pkt.xid, result=True), cli)
+	def Pushed(self, pkt, cli):
+		handle=self.refs.get((cli.addr, pkt.oid))
+		ref=(handle() if handle is not None else None)
+		if ref is not None:
+			ref.Pushed(pkt)
 	def cmd_PULL(self, pkt, cli):
-		threading.Thread(target=self.cmd_PULL_inner, args=(pkt, cli)).start()
+		if pkt.Has('on') and self.Park(pkt, cli):
+			return
+		lane=(cli.addr if self.ordered else None)
+		if not self.pool.Submit(self.cmd_PULL_inner, (pkt, cli), lane):
+			pkt.error=ServiceBusy('Too many pulls waiting')
+			self.Reply(pkt, cli)
 	def cmd_PULL_inner(self, pkt, cli):
+		#Results are kept once they're answered, so that the reply measures
+		#them; pulls on them that arrive meanwhile wait in Park.
 		try:
-			obj=self.omap[pkt.oid]
-			if not self.auth.CanClientAccess(cli, obj, pkt):
-				raise RuntimeError('Access denied')
-			pkt.result=getattr(self, 'pull_'+pkt.op, self.pull_Unknown)(proxy.ReverseProxy(obj), pkt, cli)
-			self.sock.sendto(str(pkt), cli.addr)
+			pkt.result=self.DoPull(pkt, cli)
+			size=self.Reply(pkt, cli)
+			if pkt.Has('keep'):
+				self.Keep(pkt, cli, True, pkt.result, size)
 		except Exception, e:
+			pkt.attrs.pop('result', None) #In case it was the result that failed
 			pkt.error=e
-			self.sock.sendto(str(pkt), cli.addr)
+			size=self.Reply(pkt, cli)
+			if pkt.Has('keep'):
+				self.Keep(pkt, cli, False, e, size)
+	def Park(self, pkt, cli):
+		#Returns True if pkt acts on the result of a pull that hasn't finished
+		#(or arrived), in which case it waits for Keep to run it.
+		with self.keptlock:
+			kept=self.kept.get((cli.addr, pkt.on))
+			if kept is None:
+				kept=self.kept[(cli.addr, pkt.on)]=Kept()
+				self.Evict()
+			if kept.ready:
+				return False
+			kept.waiting.append((pkt, cli))
+			return True
+	def Keep(self, pkt, cli, ok, value, size):
+		#Keeps the result of a pipelined pull for those that act on it, and
+		#runs any that came first. size is its reply's; objects sent by
+		#reference are small there, but the peer holds them anyway.
+		key=(cli.addr, pkt.xid)
+		with self.keptlock:
+			kept=self.kept.pop(key, None) or Kept()
+			self.kept[key]=kept #Now the newest
+			kept.ready=True
+			kept.ok=ok
+			kept.value=value
+			kept.size=size
+			self.keptbytes+=size
+			waiting, kept.waiting=kept.waiting, []
+			self.Evict()
+		for pkt, cli in waiting:
+			self.cmd_PULL(pkt, cli)
+	def Evict(self):
+		#Drops the oldest kept results past PROMISES or PROMISE_BYTES. A pull
+		#still waiting on one (whose own pull must have been lost) is answered
+		#with an error. The caller holds keptlock.
+		while len(self.kept)>self.PROMISES or self.keptbytes>self.PROMISE_BYTES:
+			key, kept=self.kept.popitem(False)
+			self.keptbytes-=kept.size
+			for pkt, cli in kept.waiting:
+				pkt.error=LookupError('Result of transaction %d is gone'%(key[1],))
+				self.Reply(pkt, cli)
+	def Unkeep(self, addr, xid=None):
+		#Drops what's kept for the peer at addr: the result of its pull xid,
+		#which it released, or else everything, as it has started over.
+		with self.keptlock:
+			keys=([(addr, xid)] if xid is not None else [k for k in self.kept if k[0]==addr])
+			for key in keys:
+				kept=self.kept.pop(key, None)
+				if kept is not None:
+					self.keptbytes-=kept.size
+	def DoPull(self, pkt, cli):
+		if pkt.Has('on'):
+			with self.keptlock:
+				kept=self.kept.get((cli.addr, pkt.on)) #Park saw it was ready...
+			if kept is None: #...but it's been evicted since
+				raise LookupError('Result of transaction %d is gone'%(pkt.on,))
+			if not kept.ok:
+				raise kept.value
+			obj=kept.value
+			pkt.oid=self.oids.get(id(obj)) #Not the root's, for Notify
+		else:
+			obj=self.omap[pkt.oid]
+		if not self.auth.CanClientAccess(cli, obj, pkt):
+			raise RuntimeError('Access denied')
+		pull=getattr(self, 'pull_'+pkt.op, self.pull_Unknown)
+		if self.metrics is None:
+			result=pull(proxy.ReverseProxy(obj), pkt, cli)
+		else:
+			start=time.time()
+			ok=False
+			try:
+				result=pull(proxy.ReverseProxy(obj), pkt, cli)
+				ok=not pkt.Has('error')
+			finally:
+				#Named by the type, and the attribute if there is one, of what it acted on
+				attr=pkt.attrs.get('attr')
+				target=type(obj).__name__+('.'+attr if isinstance(attr, basestring) else '')
+				self.metrics.Pulled(cli.addr, pkt.op, target, time.time()-start, ok)
+		if pkt.Has('error'):
+			raise pkt.error
+		return result
+	def cmd_BATCH(self, pkt, cli):
+		lane=(cli.addr if self.ordered else None)
+		if not self.pool.Submit(self.cmd_BATCH_inner, (pkt, cli), lane):
+			self.Reply(packet.Packet(CMD.BATCH, xid=pkt.xid, error=ServiceBusy('Too many pulls waiting')), cli)
+	def cmd_BATCH_inner(self, pkt, cli):
+		#Each op is a dict of the attributes its own PULL would have had. The
+		#reply is a list of (True, result) or (False, error), one per op.
+		results=[]
+		for op in pkt.ops:
+			try:
+				results.append((True, self.DoPull(packet.Packet(CMD.PULL, **op), cli)))
+			except Exception, e:
+				results.append((False, e))
+		try:
+			self.Reply(packet.Packet(CMD.BATCH, xid=pkt.xid, result=results), cli)
+		except Exception, e:
+			self.Reply(packet.Packet(CMD.BATCH, xid=pkt.xid, error=e), cli)
 	def cmd_RESOLVE(self, pkt, cli):
 		if pkt.name in self.pubmap:
 			pkt.result=self.omap[self.pubmap[pkt.name]]
+			if pkt.Has('describe'):
+				pkt.methods=self.Methods(pkt.result)
 		else:
 			pkt.error=NameError('No such name')
-		self.sock.sendto(str(pkt), cli.addr)
+		self.Reply(pkt, cli)
+	def Methods(self, obj):
+		#The names of obj's public methods: routines of its class that an
+		#instance attribute doesn't hide.
+		inst=getattr(obj, '__dict__', {})
+		return [name for name in dir(type(obj)) if not name.startswith('_')
+			and name not in inst and inspect.isroutine(getattr(type(obj), name, None))]
 	def cmd_LIST(self, pkt, cli):
 		pkt.result=self.pubmap.keys()
-		self.sock.sendto(str(pkt), cli.addr)
+		self.Reply(pkt, cli)
 	def cmd_Unknown(self, pkt, cli):
 		print 'Warning: Bad packet command:', repr(pkt)
 		pkt.error=NameError('Unknown command')
-		self.sock.sendto(str(pkt), cli.addr)
+		self.Reply(pkt, cli)
 	def pull_GetAttr(self, obj, pkt, cli):
 		return obj.GetAttr(pkt.attr)
 	def pull_SetAttr(self, obj, pkt, cli):
 		obj.SetAttr(pkt.attr, pkt.val)
+		self.Notify(pkt.oid, cli, attr=pkt.attr, val=pkt.val)
 	def pull_DelAttr(self, obj, pkt, cli):
 		obj.DelAttr(pkt.attr)
+		self.Notify(pkt.oid, cli, attr=pkt.attr)
 	def pull_GetItem(self, obj, pkt, cli):
 		return obj.GetItem(pkt.item)
 	def pull_SetItem(self, obj, pkt, cli):
 		obj.SetItem(pkt.item, pkt.val)
+		self.Notify(pkt.oid, cli, len=True)
 	def pull_DelItem(self, obj, pkt, cli):
 		obj.DelItem(pkt.item)
+		self.Notify(pkt.oid, cli, len=True)
 	def pull_Len(self, obj, pkt, cli):
 		return obj.Len()
 	def pull_Repr(self, obj, pkt, cli):
@@ -368,6 +2261,61 @@ class Service(threading.Thread):
 		return obj.Str()
 	def pull_Call(self, obj, pkt, cli):
 		return obj.Call(*pkt.args, **pkt.kwargs)
+	def pull_CallMethod(self, obj, pkt, cli):
+		return obj.CallMethod(pkt.attr, *pkt.args, **pkt.kwargs)
+	def pull_Iter(self, obj, pkt, cli):
+		return obj.Iter(pkt.count)
+	def pull_Next(self, obj, pkt, cli):
+		return obj.Next(pkt.count)
+	def pull_Subscribe(self, obj, pkt, cli):
+		self.subscribers.setdefault(pkt.oid, set()).add(cli.addr)
+		return True
+	def pull_Unsubscribe(self, obj, pkt, cli):
+		subs=self.subscribers.get(pkt.oid)
+		if subs is not None:
+			subs.discard(cli.addr)
+			if not subs:
+				self.subscribers.pop(pkt.oid, None)
 	def pull_Unknown(self, obj, pkt, cli):
 		print 'Warning: Bad packet pull:', repr(pkt)
-		pkt.error=NameError('Unknown pull')
\ No newline at end of file
+		pkt.error=NameError('Unknown pull')
+
+def Serve(addr, setup, processes=None, **kwargs):
+	#Runs processes Services (by default, one per CPU), each in a process of
+	#its own, as the shards of one at addr (see Shard). setup(srv) is called
+	#in each to Register objects; each shard has its own, so objects that
+	#keep state shared by every peer are best kept elsewhere. The rest of
+	#kwargs go to each Service. Returns the address they share, and the pids
+	#of their processes.
+	processes=processes or multiprocessing.cpu_count()
+	socks=[]
+	for index in xrange(processes):
+		sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+		sock.bind(socks[0].getsockname() if socks else addr)
+		socks.append(sock)
+	relays=[]
+	for index in xrange(processes):
+		relay=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		relay.bind(('127.0.0.1', 0))
+		relays.append(relay)
+	pids=[]
+	for index in xrange(processes):
+		pid=os.fork()
+		if pid==0:
+			try:
+				shard=Shard(index, processes, socks[index], relays)
+				for other in socks+relays:
+					if other is not socks[index] and other is not relays[index]:
+						other.close()
+				srv=Service(addr, shard=shard, **kwargs)
+				setup(srv)
+				srv.start()
+				srv.join()
+			finally:
+				os._exit(0)
+		pids.append(pid)
+	addr=socks[0].getsockname()
+	for sock in socks+relays:
+		sock.close()
+	return addr, pids
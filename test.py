@@ -8,8 +8,12 @@ class X(object):
 		return self
 	def c(self):
 		return self.d()
+	def e(self):
+		return X()
+	def live(self):
+		return len(srv.omap)
 	
 x=X()
 srv.Register(x, 'X')
 
-srv.start()
\ No newline at end of file
+srv.start()
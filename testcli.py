@@ -1,5 +1,19 @@
-import service
+import service, time
 srv=service.Service(('', 12075))
 srv.start()
 cli=srv.Connect(('127.0.0.1', 12074))
-rx=srv.Resolve(cli, 'X')
\ No newline at end of file
+rx=srv.Resolve(cli, 'X')
+
+#Both Services are bound to every interface, so references carry only a
+#port; they still belong to the Client they came through...
+assert rx.b()._obj.cli is cli
+with cli.Batch() as b:
+	a=b.Bind(rx.b().a)()
+assert a.Result()==1
+#...and are released once collected.
+for i in xrange(100):
+	rx.e()
+deadline=time.time()+5
+while rx.live()>2 and time.time()<deadline:
+	time.sleep(0.1)
+assert rx.live()<=2, rx.live()